@@ -2,39 +2,173 @@ from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import os
 import threading
 import logging
+import errno
 import re
-import subprocess
+import selectors
+import shutil
+import socket
+import tempfile
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+import xmlrpc.client
+import zlib
+import chunked
+import compression
+import delta
+import sparse
+import sxmlr
+import transfer
+from paths import TEMP_PREFIX
 
 logger = logging.getLogger("tsync")
 logger.setLevel(logging.DEBUG)
 
+# Returned by req_push_file when the receiver already holds the pushed content
+UP_TO_DATE = ''
+# Requests handled at once by the RPC server, and requests allowed to wait for a worker
+RPC_WORKERS = 16
+RPC_MAX_PENDING = 64
+# Seconds an idle keep-alive RPC connection is held open by the server
+KEEPALIVE_TIMEOUT = 15
+# Seconds between sweeps for idle keep-alive connections that have timed out
+KEEPALIVE_SWEEP = 1
+# Files up to this size travel compressed inside the RPC instead of through a separate transfer
+INLINE_MAX_SIZE = 64 * 1024
+
 
 class FunctionHandler(SimpleXMLRPCRequestHandler):
     """Custom request handler to return a requested function call from the server side."""
 
+    # Keep connections open between calls so peers can reuse them (see sxmlr.ConnectionPool);
+    # between calls the server parks them without a worker (see PooledXMLRPCServer)
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def handle(self):
+        """Serve a single request; whether to keep the connection is left in close_connection."""
+        self.close_connection = True
+        self.handle_one_request()
+
     def _dispatch(self, method, params):
         try:
-            logger.debug("Server type: %s", type(self.server))
-            logger.debug("Server funcs: %s", self.server.funcs)
+            logger.debug("RPC call: %s", method)
             return self.server.funcs[method](*params)
         except:
             traceback.print_exc()
             raise
 
 
+class PooledXMLRPCServer(SimpleXMLRPCServer):
+    """XML-RPC server that handles requests concurrently on a bounded pool of worker threads.
+
+    Once max_workers requests are running and max_pending more are queued, the accept loop
+    waits for a slot instead of queueing without limit. A worker serves one request at a time:
+    a keep-alive connection then waits in a selector, holding no worker, until its next request
+    arrives or it has been idle for keepalive_timeout seconds. Peers must wait for each response
+    before sending the next request, as xmlrpc.client does.
+    """
+
+    def __init__(self, addr, max_workers=RPC_WORKERS, max_pending=RPC_MAX_PENDING,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tsync-rpc')
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.keepalive_timeout = keepalive_timeout
+        self.idle = selectors.DefaultSelector()
+        self.parking = []  # (request, client_address) waiting to be added to the selector
+        self.parking_lock = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.idle.register(self.wake_r, selectors.EVENT_READ)
+        self.closed = False
+        threading.Thread(target=self._watch_idle, daemon=True).start()
+
+    def finish_request(self, request, client_address):
+        """Serve one request and return True if the connection is to be kept open."""
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return not getattr(handler, 'close_connection', True)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.executor.submit(self._process_request_worker, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _process_request_worker(self, request, client_address):
+        keep = False
+        try:
+            keep = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.slots.release()
+            if keep and not self.closed:
+                self._park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def _park(self, request, client_address):
+        """Hand an idle keep-alive connection to the selector thread."""
+        with self.parking_lock:
+            self.parking.append((request, client_address))
+        self.wake_w.send(b'\0')
+
+    def _watch_idle(self):
+        """Dispatch parked connections as their next request arrives and close those left idle."""
+        while not self.closed:
+            events = self.idle.select(KEEPALIVE_SWEEP)
+            now = time.monotonic()
+            with self.parking_lock:
+                parked, self.parking = self.parking, []
+            for request, client_address in parked:
+                self.idle.register(request, selectors.EVENT_READ, (client_address, now))
+            for key, _ in events:
+                if key.fileobj is self.wake_r:
+                    try:
+                        self.wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.idle.unregister(key.fileobj)
+                try:
+                    self.process_request(key.fileobj, key.data[0])
+                except Exception:
+                    self.shutdown_request(key.fileobj)
+            for key in list(self.idle.get_map().values()):
+                if key.data is not None and now - key.data[1] >= self.keepalive_timeout:
+                    self.idle.unregister(key.fileobj)
+                    self.shutdown_request(key.fileobj)
+        for key in list(self.idle.get_map().values()):
+            if key.data is not None:
+                self.shutdown_request(key.fileobj)
+        self.idle.close()
+
+    def server_close(self):
+        super().server_close()
+        self.closed = True
+        self.wake_w.send(b'\0')
+        self.executor.shutdown(wait=False)
+
+
 class Base:
     """Base class for both Server and Client."""
 
-    def __init__(self, role, ip, port, uname, watch_dirs):
+    def __init__(self, role, ip, port, uname, watch_dirs, rpc_workers=RPC_WORKERS):
         self.role = role
         self.ip = ip
         self.port = port
         self.username = uname
         self.watch_dirs = watch_dirs
+        self.checkpoints = chunked.TransferCheckpoints(
+            pkl_filename=f'{role}-chunks.pkl',
+            partial_dir=os.path.join("/home", uname, ".tsync", chunked.PARTIAL_DIR))
 
         # Register the methods for XML-RPC
-        self.server = SimpleXMLRPCServer((self.ip, self.port), requestHandler=FunctionHandler, allow_none=True)
+        self.server = PooledXMLRPCServer((self.ip, self.port), max_workers=rpc_workers,
+                                         requestHandler=FunctionHandler, allow_none=True)
         self.server.funcs = {}
         self.register_methods()
         self.server.register_introspection_functions()
@@ -44,6 +178,15 @@ class Base:
         self.server.funcs['req_push_file'] = self.req_push_file
         self.server.funcs['ack_push_file'] = self.ack_push_file
         self.server.funcs['get_public_key'] = self.get_public_key
+        self.server.funcs['get_signature'] = self.get_signature
+        self.server.funcs['apply_delta'] = self.apply_delta
+        self.server.funcs['write_file_inline'] = self.write_file_inline
+        self.server.funcs['get_compression_stats'] = self.get_compression_stats
+        self.server.funcs['append_file'] = self.append_file
+        self.server.funcs['begin_chunked'] = self.begin_chunked
+        self.server.funcs['put_chunk'] = self.put_chunk
+        self.server.funcs['put_holes'] = self.put_holes
+        self.server.funcs['finish_chunked'] = self.finish_chunked
         #self.server.funcs['pull_file'] = self.pull_file
 
     def ack_push_file(self, *args):
@@ -74,17 +217,327 @@ class Base:
         logger.debug("Destination path: %s", destpath)
         return destpath
 
+    def safe_path(self, path):
+        """Return 'path' normalised if it lies inside one of the watch dirs, else None.
+
+        Paths arrive from RPC callers, so neither '..' components nor symlinked parent directories
+        may lead out of the synced trees; the watch dirs themselves are refused too.
+        """
+        if not isinstance(path, str) or not os.path.isabs(path):
+            return None
+        path = os.path.normpath(path)
+        real = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        for watch_dir in self.watch_dirs:
+            root = os.path.realpath(watch_dir)
+            if real.startswith(root.rstrip(os.sep) + os.sep):
+                return path
+        logger.error("Refusing path outside the watch dirs: %s", path)
+        return None
+
     @staticmethod
     def push_file(filename, dest_uname, dest_ip, role):
-        """Push a file to the destination user and IP using scp."""
+        """Push a file to the destination user and IP over the pooled transfer connection."""
         try:
             dest_path = Base.get_dest_path(filename, dest_uname, role)
-            proc = subprocess.Popen(['scp', filename, f"{dest_uname}@{dest_ip}:{dest_path}"])
-            return_status = proc.wait()
+            compress = compression.should_compress(filename, dest_ip)
+            return_status = transfer.pool.get(dest_uname, dest_ip).push(filename, dest_path, compress)
             logger.debug("SCP returned status in push_file of base class: %s", return_status)
         except Exception as e:
             logger.error("Error pushing file: %s", e)
 
+    @staticmethod
+    def push_delta(filename, dest_ip, dest_port, dest_file, digest=None):
+        """Send only the blocks of 'filename' that differ from the peer's copy of dest_file.
+
+        Returns False whenever the caller should fall back to a whole-file copy.
+        """
+        try:
+            if os.path.getsize(filename) < delta.DELTA_MIN_SIZE:
+                return False
+        except OSError:
+            return False
+        signature = sxmlr.get_signature(dest_ip, dest_port, dest_file)
+        if not signature:
+            logger.debug("No basis for %s on %s, falling back to whole-file copy", dest_file, dest_ip)
+            return False
+        block_size, sig = signature
+        payload = delta.compute_delta(filename, block_size, sig.data)
+        if payload is None:
+            return False
+        if digest is None:
+            digest = delta.file_digest(filename)
+        status = sxmlr.apply_delta(dest_ip, dest_port, dest_file, block_size, xmlrpc.client.Binary(payload),
+                                   digest)
+        logger.debug("Delta of %d bytes for %s applied on %s: %s", len(payload), filename, dest_ip, status)
+        return status is True
+
+    def append_file(self, filename, start, offset, payload, compressed, digest):
+        """Write bytes sent by a peer at 'offset' in 'filename', which the peer had synced up to 'start'.
+
+        The local copy must hold at least 'offset' bytes; anything past it, left by a transfer that
+        raced a growing file, is replaced. The last call of an append carries the digest of the
+        whole file: if the local copy does not match it, as when its first 'start' bytes differ
+        from the peer's, it is truncated back to 'start' and False is returned.
+        """
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        start, offset = int(start), int(offset)
+        try:
+            data = compression.unpack(payload.data, compressed)
+            with open(filename, 'r+b') as fp:
+                if os.fstat(fp.fileno()).st_size < offset:
+                    logger.debug("Local copy of %s is shorter than the appended-to prefix", filename)
+                    return False
+                fp.truncate(offset)
+                fp.seek(offset)
+                fp.write(data)
+            if digest is not None and delta.file_digest(filename) != digest:
+                logger.error("Digest mismatch after appending to %s, rolling back", filename)
+                os.truncate(filename, start)
+                return False
+        except (OSError, ValueError, zlib.error) as e:
+            logger.error("Error appending to %s: %s", filename, e)
+            return False
+        logger.debug("Appended %d bytes to %s", len(data), filename)
+        return True
+
+    @staticmethod
+    def push_chunked(filename, dest_ip, dest_port, dest_file, digest=None, chunk_size=chunked.CHUNK_SIZE):
+        """Send 'filename' in verified chunks, resuming after the last chunk the peer already has.
+
+        Returns True once the peer has the whole file in place.
+        """
+        try:
+            size = os.path.getsize(filename)
+            if digest is None:
+                digest = delta.file_digest(filename)
+        except OSError as e:
+            logger.error("Error reading %s: %s", filename, e)
+            return False
+        done = sxmlr.begin_chunked(dest_ip, dest_port, dest_file, str(size), digest, chunk_size)
+        if isinstance(done, bool) or not isinstance(done, int):
+            logger.error("Peer %s refused chunked transfer of %s", dest_ip, dest_file)
+            return False
+        if done:
+            logger.info("Resuming transfer of %s to %s at chunk %d", filename, dest_ip, done)
+        count = chunked.chunk_count(size, chunk_size)
+        compress = compression.should_compress(filename)
+        try:
+            with open(filename, 'rb') as fp:
+                extents = sparse.data_extents(fp.fileno(), 0, size)
+                index = done
+                while index < count:
+                    if not sparse.has_data(extents, index * chunk_size, (index + 1) * chunk_size):
+                        # A run of chunks that are all hole costs one call and no reads
+                        end = index + 1
+                        while end < count and not sparse.has_data(extents, end * chunk_size,
+                                                                  (end + 1) * chunk_size):
+                            end += 1
+                        if sxmlr.put_holes(dest_ip, dest_port, dest_file, index, end - index) is not True:
+                            logger.error("Holes at chunk %d of %s were not accepted by %s", index, filename,
+                                         dest_ip)
+                            return False
+                        index = end
+                        continue
+                    fp.seek(index * chunk_size)
+                    data = fp.read(chunk_size)
+                    payload, compressed = compression.pack(data, compress, dest_ip)
+                    status = sxmlr.put_chunk(dest_ip, dest_port, dest_file, index, xmlrpc.client.Binary(payload),
+                                             chunked.chunk_digest(data), compressed)
+                    if status is not True:
+                        logger.error("Chunk %d of %s was not accepted by %s", index, filename, dest_ip)
+                        return False
+                    index += 1
+        except OSError as e:
+            logger.error("Error reading %s: %s", filename, e)
+            return False
+        status = sxmlr.finish_chunked(dest_ip, dest_port, dest_file)
+        logger.debug("Chunked transfer of %s to %s finished: %s", filename, dest_ip, status)
+        return status is True
+
+    def begin_chunked(self, filename, size, digest, chunk_size):
+        """Prepare to receive 'filename' in chunks and return how many chunks are already here."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        try:
+            return self.checkpoints.begin(filename, int(size), digest, chunk_size).done
+        except OSError as e:
+            logger.error("Error preparing chunked transfer of %s: %s", filename, e)
+            return False
+
+    def put_chunk(self, filename, index, payload, digest, compressed):
+        """Verify one chunk of 'filename' and write it to the partial file."""
+        filename = self.safe_path(filename)
+        checkpoint = self.checkpoints.get(filename)
+        if checkpoint is None or index > checkpoint.done:
+            logger.error("Unexpected chunk %d of %s", index, filename)
+            return False
+        if index < checkpoint.done:
+            return True  # Already written before the transfer was interrupted
+        try:
+            data = compression.unpack(payload.data, compressed)
+        except zlib.error as e:
+            logger.error("Error unpacking chunk %d of %s: %s", index, filename, e)
+            return False
+        if chunked.chunk_digest(data) != digest:
+            logger.error("Chunk %d of %s failed verification", index, filename)
+            return False
+        try:
+            with open(checkpoint.part, 'r+b') as fp:
+                fp.seek(index * checkpoint.chunk_size)
+                sparse.write_sparse(fp, data)
+                fp.flush()
+                # The checkpoint must never claim a chunk that is not on disk
+                os.fsync(fp.fileno())
+        except OSError as e:
+            logger.error("Error writing chunk %d of %s: %s", index, filename, e)
+            return False
+        self.checkpoints.put(filename, checkpoint._replace(done=index + 1))
+        return True
+
+    def put_holes(self, filename, index, count):
+        """Skip 'count' chunks of 'filename' from 'index' on that are holes on the sender."""
+        filename = self.safe_path(filename)
+        checkpoint = self.checkpoints.get(filename)
+        if checkpoint is None or index > checkpoint.done:
+            logger.error("Unexpected holes at chunk %d of %s", index, filename)
+            return False
+        # The partial file was created sparse at its full size, so the holes are already there
+        self.checkpoints.put(filename, checkpoint._replace(done=max(checkpoint.done, index + count)))
+        return True
+
+    def finish_chunked(self, filename):
+        """Verify the fully received 'filename' and move it into place."""
+        filename = self.safe_path(filename)
+        checkpoint = self.checkpoints.get(filename)
+        if checkpoint is None or checkpoint.done < chunked.chunk_count(checkpoint.size, checkpoint.chunk_size):
+            logger.error("Chunked transfer of %s is not complete", filename)
+            return False
+        try:
+            os.truncate(checkpoint.part, checkpoint.size)
+            if delta.file_digest(checkpoint.part) != checkpoint.digest:
+                logger.error("Received %s does not match its digest, starting over", filename)
+                self.checkpoints.discard(filename)
+                return False
+            self.move_into_place(checkpoint.part, filename)
+        except OSError as e:
+            logger.error("Error completing chunked transfer of %s: %s", filename, e)
+            return False
+        self.checkpoints.discard(filename)
+        logger.debug("Received %s in %d chunks", filename, checkpoint.done)
+        return True
+
+    @staticmethod
+    def move_into_place(source, filename):
+        """Atomically replace 'filename' with the file at 'source', keeping the old file's mode."""
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        if os.path.exists(filename):
+            shutil.copymode(filename, source)
+        else:
+            os.chmod(source, 0o644)
+        try:
+            os.replace(source, filename)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Different filesystem: copy next to the target first so the final step is still a rename
+            fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX + 'chunked-', dir=os.path.dirname(filename) or '.')
+            os.close(fd)
+            try:
+                shutil.copy(source, tmp_path)
+                os.replace(tmp_path, filename)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            os.unlink(source)
+
+    @staticmethod
+    def rename_local(src, dest):
+        """Rename a synced file or directory; return True if 'dest' is now in place."""
+        if not os.path.lexists(src):
+            return os.path.lexists(dest)  # Already applied, or never synced here
+        try:
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            os.replace(src, dest)
+        except OSError as e:
+            logger.error("Error renaming %s to %s: %s", src, dest, e)
+            return False
+        return True
+
+    @staticmethod
+    def delete_local(path):
+        """Delete a synced file or directory tree."""
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+        except OSError as e:
+            logger.error("Error deleting %s: %s", path, e)
+            return False
+        return True
+
+    def get_signature(self, filename):
+        """Return [block_size, signature] of the local copy of 'filename', or False if there is none."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        result = delta.file_signature(filename)
+        if result is None:
+            return False
+        block_size, signature = result
+        return [block_size, xmlrpc.client.Binary(signature)]
+
+    def apply_delta(self, filename, block_size, payload, digest):
+        """Patch the local copy of 'filename' with a delta sent by a peer."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        try:
+            delta.apply_delta(filename, payload.data, block_size, filename, digest)
+        except (OSError, ValueError, zlib.error) as e:
+            logger.error("Error applying delta to %s: %s", filename, e)
+            return False
+        logger.debug("Applied delta to %s", filename)
+        return True
+
+    @staticmethod
+    def replace_file(filename, data):
+        """Write 'data' to a temporary file next to 'filename' and move it into place."""
+        dirname = os.path.dirname(filename) or '.'
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX + 'inline-', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            if os.path.exists(filename):
+                shutil.copymode(filename, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def write_file_inline(self, filename, payload, compressed=True):
+        """Write a small file whose contents, compressed or not, were sent inside the RPC."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        try:
+            self.replace_file(filename, compression.unpack(payload.data, compressed))
+        except (OSError, zlib.error) as e:
+            logger.error("Error writing inline file %s: %s", filename, e)
+            return False
+        logger.debug("Wrote inline file %s", filename)
+        return True
+
+    def get_compression_stats(self):
+        """Return per-peer compression totals for transfers sent from this node."""
+        return compression.stats.report()
+
     def get_public_key(self, *args):
         """Return public key of this client."""
         pubkey_dirname = os.path.join("/home", self.username, ".ssh")
@@ -0,0 +1,107 @@
+import logging
+from collections import OrderedDict
+
+from paths import moved_path
+from persistence import PersistentDict
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+
+class ChangeLog(PersistentDict):
+    """Shared, append-only log of changes to the server mirror, numbered by generation.
+
+    Each change is (op, path, dest, origin, target): op is 'write', 'rename' or 'delete'; dest is
+    the new path of a rename; origin is the id of the client that made the change, which does not
+    get it back; target, if set, is the id of the only client the change is meant for. Alongside
+    the log, the generation each client has applied up to is kept, and the log is trimmed below
+    the oldest one.
+    """
+
+    def __init__(self, pkl_filename, wakeup=None):
+        self.cursors = {}  # client id -> last applied generation
+        super().__init__(pkl_filename, wakeup=wakeup)
+
+    @property
+    def generation(self):
+        """The newest generation, 0 for an empty log."""
+        with self.lock:
+            return next(reversed(self.set), 0)
+
+    def _new_set(self):
+        """Return the empty generation -> change mapping, kept in generation order."""
+        return OrderedDict()
+
+    def _apply(self, op, element):
+        """Apply a journal operation; cursors are journaled under ('cursor', client_id) keys."""
+        if op == 'add' and isinstance(element[0], tuple):
+            (_, client_id), generation = element
+            self.cursors[client_id] = generation
+        else:
+            super()._apply(op, element)
+
+    def _snapshot(self):
+        """Return the changes and cursors in the form they are journaled in."""
+        return super()._snapshot() + [(('cursor', client_id), generation)
+                                      for client_id, generation in self.cursors.items()]
+
+    def append(self, op, path, dest=None, origin=None, target=None):
+        """Record a change under the next generation and return that generation."""
+        with self.lock:
+            generation = self.generation + 1
+            self._put(generation, (op, path, dest, origin, target))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return generation
+
+    def cursor(self, client_id):
+        """Return the generation a client has applied up to."""
+        with self.lock:
+            return self.cursors.get(client_id, 0)
+
+    def advance(self, client_id, generation):
+        """Record that a client has applied every change up to 'generation'."""
+        with self.lock:
+            if generation > self.cursors.get(client_id, 0):
+                self._put(('cursor', client_id), generation)
+
+    def trim(self, client_ids):
+        """Drop changes every one of the given clients has applied, keeping the newest generation."""
+        with self.batch():
+            oldest = min((self.cursors.get(client_id, 0) for client_id in client_ids), default=0)
+            for generation in [generation for generation in self.set if generation < oldest]:
+                self._delete(generation)
+
+    def since(self, generation, client_id):
+        """Return (newest generation, ops, writes): the compacted changes a client needs after 'generation'.
+
+        'ops' lists ('rename', src, dest) and ('delete', path) in order; 'writes' lists the paths
+        whose current content must be sent, once each and under their final names, after the ops.
+        """
+        with self.lock:
+            changes = [(gen, change) for gen, change in self.set.items() if gen > generation]
+        ops = []
+        writes = OrderedDict()
+        for gen, (op, path, dest, origin, target) in changes:
+            if target is not None and target != client_id:
+                continue
+            if op == 'write':
+                # A later write replaces an earlier one; the client already has its own
+                writes.pop(path, None)
+                if origin != client_id:
+                    writes[path] = gen
+            elif op == 'rename':
+                # A rename replaces whatever was at dest and carries pending writes along
+                for pending in [pending for pending in writes if moved_path(pending, dest, dest)]:
+                    del writes[pending]
+                for pending in [pending for pending in writes if moved_path(pending, path, dest)]:
+                    writes[moved_path(pending, path, dest)] = writes.pop(pending)
+                if origin != client_id:
+                    ops.append(('rename', path, dest))
+            elif op == 'delete':
+                for pending in [pending for pending in writes if moved_path(pending, path, path)]:
+                    del writes[pending]
+                if origin != client_id:
+                    ops.append(('delete', path))
+        newest = changes[-1][0] if changes else generation
+        return newest, ops, list(writes)
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import os
+from collections import namedtuple
+
+from persistence import PersistentDict
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Large files travel in chunks of this size, each one acknowledged before the next is sent
+CHUNK_SIZE = 4 * 1024 * 1024
+# Files at least this big are sent in resumable chunks instead of one transfer
+CHUNKED_MIN_SIZE = 64 * 1024 * 1024
+# Directory under ~/.tsync holding partially received files; it is outside the watch dirs
+PARTIAL_DIR = '.partial'
+
+Checkpoint = namedtuple('Checkpoint', ['part', 'size', 'digest', 'chunk_size', 'done'])
+
+
+def chunk_digest(data):
+    """Return the hex digest used to verify one chunk."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def chunk_count(size, chunk_size):
+    """Return the number of chunks a file of 'size' bytes is split into."""
+    return max(1, -(-size // chunk_size))
+
+
+class TransferCheckpoints(PersistentDict):
+    """Persistent dest path -> Checkpoint of chunked transfers being received.
+
+    A checkpoint names the partial file, the size and digest of the complete file, and how many
+    leading chunks of it are already written, so an interrupted transfer resumes where it stopped.
+    """
+
+    def __init__(self, pkl_filename, partial_dir):
+        self.partial_dir = partial_dir
+        super().__init__(pkl_filename)
+
+    def get(self, path):
+        """Return the checkpoint of 'path', or None."""
+        with self.lock:
+            return self.set.get(path)
+
+    def put(self, path, checkpoint):
+        """Record the progress of the transfer to 'path'."""
+        with self.lock:
+            self._put(path, checkpoint)
+
+    def begin(self, path, size, digest, chunk_size):
+        """Return the checkpoint to continue the transfer to 'path' from, starting over if needed.
+
+        The transfer resumes only if the same content is being sent in the same chunks and the
+        partial file still holds the chunks recorded as done.
+        """
+        with self.lock:
+            checkpoint = self.set.get(path)
+            if checkpoint is not None:
+                if (checkpoint.size, checkpoint.digest, checkpoint.chunk_size) == (size, digest, chunk_size):
+                    try:
+                        if os.path.getsize(checkpoint.part) >= min(size, checkpoint.done * chunk_size):
+                            logger.debug("Resuming %s at chunk %d", path, checkpoint.done)
+                            return checkpoint
+                    except OSError:
+                        pass
+                self.discard(path)
+            os.makedirs(self.partial_dir, exist_ok=True)
+            part = os.path.join(self.partial_dir, hashlib.blake2b(path.encode()).hexdigest()[:32] + '.part')
+            # Sized up front and left sparse: chunks that are holes on the sender are never written
+            with open(part, 'wb') as fp:
+                fp.truncate(size)
+            checkpoint = Checkpoint(part, size, digest, chunk_size, 0)
+            self.put(path, checkpoint)
+            return checkpoint
+
+    def discard(self, path):
+        """Forget the transfer to 'path' and delete its partial file."""
+        with self.lock:
+            checkpoint = self.set.get(path)
+            if checkpoint is None:
+                return
+            self._delete(path)
+        try:
+            os.unlink(checkpoint.part)
+        except OSError:
+            pass
@@ -0,0 +1,233 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import delta
+from chunked import chunk_digest
+from paths import TEMP_PREFIX
+from persistence import PersistentDict
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Content-defined chunk sizes: no cut before MIN, aim for AVG, force a cut at MAX
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+# Files in this size range are offered to the chunk store before any other whole-file transfer;
+# chunking runs in Python at about 6 MB/s, so larger files are left to the resumable chunked transfer
+DEDUP_MIN_SIZE = 256 * 1024
+DEDUP_MAX_SIZE = 32 * 1024 * 1024
+# Only this much of a file is chunked up front; the rest is chunked only if the server already
+# holds some of those first chunks, so new files do not pay for a whole chunking pass
+DEDUP_PROBE_SIZE = 1024 * 1024
+# Missing chunks are uploaded in RPCs of about this many bytes
+PUT_BATCH_BYTES = 4 * 1024 * 1024
+
+# Both ends must cut at the same places, so the gear table is derived rather than random
+GEAR = [struct.unpack('>I', hashlib.blake2b(b'tsync-gear-%d' % i, digest_size=4).digest())[0]
+        for i in range(256)]
+# Normalized chunking: a harder cut condition before the average size, an easier one after it
+MASK_SMALL = ((1 << 18) - 1) << 14
+MASK_LARGE = ((1 << 14) - 1) << 18
+
+
+def _cut_point(data, start, end):
+    """Return the end of the chunk starting at 'start', using a gear hash over data[start:end]."""
+    if end - start <= CDC_MIN_SIZE:
+        return end
+    normal = min(start + CDC_AVG_SIZE, end)
+    h = 0
+    pos = start + CDC_MIN_SIZE
+    for byte in data[pos:normal]:
+        h = ((h << 1) + GEAR[byte]) & 0xffffffff
+        pos += 1
+        if not h & MASK_SMALL:
+            return pos
+    for byte in data[normal:end]:
+        h = ((h << 1) + GEAR[byte]) & 0xffffffff
+        pos += 1
+        if not h & MASK_LARGE:
+            return pos
+    return end
+
+
+def file_chunks(path, start=0, limit=None):
+    """Split a file at content-defined boundaries and return its (offset, length, digest) chunks.
+
+    Boundaries depend only on nearby bytes, so an insertion shifts the data after it without
+    changing its chunks. Chunking begins at 'start', which must be a boundary, and stops at the
+    first boundary at or past 'limit' if given.
+    """
+    chunks = []
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size == 0:
+            return chunks
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while start < size and (limit is None or start < limit):
+                end = _cut_point(data, start, min(start + CDC_MAX_SIZE, size))
+                chunks.append((start, end - start, chunk_digest(data[start:end])))
+                start = end
+    return chunks
+
+
+class ChunkStore(PersistentDict):
+    """Persistent content-addressed store of chunks, keyed by chunk digest.
+
+    Chunks already present in synced files are not copied: the store maps their digest to
+    (path, offset, length, mtime_ns) of a file holding them, and a reference is trusted only while
+    that file is unchanged. Chunks uploaded for a file being assembled are kept as blobs under
+    'blob_dir' until the file is complete, then they become references into it too.
+    """
+
+    def __init__(self, pkl_filename, blob_dir):
+        self.blob_dir = blob_dir
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tsync-chunks')
+        self.indexed = {}  # path -> mtime_ns of the version whose chunks were last recorded
+        super().__init__(pkl_filename)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def _valid(self, reference, mtimes):
+        path, mtime_ns = reference[0], reference[3]
+        if path not in mtimes:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes[path] == mtime_ns
+
+    def _drop(self, digest):
+        with self.lock:
+            self._delete(digest)
+
+    def missing(self, digests):
+        """Return the digests of chunks the store cannot supply."""
+        mtimes = {}
+        with self.lock:
+            references = {digest: self.set.get(digest) for digest in digests}
+        return [digest for digest, reference in references.items()
+                if not (reference is not None and self._valid(reference, mtimes)) and
+                not os.path.exists(self._blob_path(digest))]
+
+    def put(self, digest, data):
+        """Store an uploaded chunk as a blob; return False if it does not match its digest."""
+        if chunk_digest(data) != digest:
+            logger.error("Uploaded chunk %s failed verification", digest)
+            return False
+        blob = self._blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX + 'chunk-', dir=os.path.dirname(blob))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, blob)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+    def read(self, digest):
+        """Return the contents of a chunk, or None if the store no longer has it."""
+        try:
+            with open(self._blob_path(digest), 'rb') as fp:
+                return fp.read()
+        except OSError:
+            pass
+        with self.lock:
+            reference = self.set.get(digest)
+        if reference is None:
+            return None
+        path, offset, length, _ = reference
+        try:
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read(length)
+        except OSError:
+            data = b''
+        if chunk_digest(data) != digest:
+            logger.debug("Chunk %s is no longer at %s:%d", digest, path, offset)
+            self._drop(digest)
+            return None
+        return data
+
+    def assemble(self, path, recipe, digest):
+        """Build 'path' from the chunks listed in 'recipe' and move it into place.
+
+        Returns False if a chunk is unavailable or the result does not hash to 'digest'.
+        """
+        dirname = os.path.dirname(path) or '.'
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX + 'assemble-', dir=dirname)
+        chunks = []
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                offset = 0
+                for chunk in recipe:
+                    data = self.read(chunk)
+                    if data is None:
+                        logger.error("Chunk %s of %s is missing", chunk, path)
+                        os.unlink(tmp_path)
+                        return False
+                    fp.write(data)
+                    chunks.append((offset, len(data), chunk))
+                    offset += len(data)
+            if delta.file_digest(tmp_path) != digest:
+                logger.error("Assembled %s does not match its digest", path)
+                os.unlink(tmp_path)
+                return False
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._add_references(path, chunks)
+        for _, _, chunk in chunks:
+            blob = self._blob_path(chunk)
+            try:
+                os.unlink(blob)
+                os.rmdir(os.path.dirname(blob))
+            except OSError:
+                pass  # Not a blob, or its directory still holds others
+        return True
+
+    def _add_references(self, path, chunks):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        with self.batch():
+            for offset, length, chunk in chunks:
+                self._put(chunk, (path, offset, length, mtime_ns))
+            self.indexed[path] = mtime_ns
+
+    def index(self, path):
+        """Record the chunks of a synced file so later transfers can reuse them."""
+        try:
+            st = os.stat(path)
+            if not DEDUP_MIN_SIZE <= st.st_size <= DEDUP_MAX_SIZE:
+                return
+            with self.lock:
+                if self.indexed.get(path) == st.st_mtime_ns:
+                    return  # Already recorded, for instance while it was assembled
+            chunks = file_chunks(path)
+        except (OSError, ValueError) as e:
+            logger.debug("Cannot index chunks of %s: %s", path, e)
+            return
+        self._add_references(path, chunks)
+        logger.debug("Indexed %d chunks of %s", len(chunks), path)
+
+    def index_later(self, path):
+        """Index a file in the background."""
+        self.indexer.submit(self.index, path)
@@ -1,18 +1,41 @@
 import logging
 import sxmlr
 from pyinotify import WatchManager, Notifier, EventsCodes
-import subprocess
 import time
 import threading
 import os
-from base import Base
+import xmlrpc.client
+import chunked
+import chunkstore
+import compression
+import delta
+import sparse
+import transfer
+from base import Base, UP_TO_DATE, INLINE_MAX_SIZE
 from filewatcher import Filewatcher
 from filepersistentset import FilesPersistentSet
-from timekeeper import TimeKeeper
+from fileindex import FileIndex
+from hashcache import HashCache
+from jobs import JobTable
+from merkle import MerkleTree, compare_child
+from oplog import OpLog
+from workers import TransferWorkers
 
 logger = logging.getLogger('tsync')
 logger.setLevel(logging.DEBUG)
 
+# Number of queued files sent to the server in one manifest
+SYNC_BATCH_SIZE = 100
+# After the first queued change, wait this long so a burst of changes goes out together
+SYNC_BATCH_WINDOW = 0.2
+# Seconds between retries while files that failed to sync are still queued
+SYNC_RETRY_INTERVAL = 10
+# Seconds between audits comparing the local tree with the server mirror
+RECONCILE_INTERVAL = 3600
+# With at least this many files queued, push them as streamed archives of SEED_BATCH_SIZE files
+SEED_MIN_FILES = 1000
+SEED_BATCH_SIZE = 5000
+
 
 class Client(Base):
     """Client class."""
@@ -20,34 +43,128 @@ class Client(Base):
     def __init__(self, role, ip, port, uname, watch_dirs, server_details):
         super(Client, self).__init__(role, ip, port, uname, watch_dirs)
         self.server_uname, self.server_ip, self.server_port = server_details
+        self.work_ready = threading.Event()
         self.mfiles = FilesPersistentSet(pkl_filename='client.pkl')
-        self.rfiles = set()
+        self.mfiles.wakeup = self.work_ready
+        self.hashes = HashCache(pkl_filename='client-hashes.pkl')
+        self.index = FileIndex(pkl_filename='client-index.pkl', hashes=self.hashes)
+        self.ops = OpLog(pkl_filename='client-ops.pkl', wakeup=self.work_ready)
         self.pulled_files = set()
         self.server_available = True
+        self.transfers = TransferWorkers()
+        self.jobs = JobTable(self.report_jobs)
+        self.jobs.start()
+        self.tree = MerkleTree(pkl_filename='client-tree.pkl', base=os.path.join("/home", uname), roots=watch_dirs,
+                               hashes=self.hashes)
+        self.next_reconcile = 0
 
         # Ensure client-specific methods are registered if not in Base
         self.server.funcs.update({
             'get_public_key': self.get_public_key,
             'pull_file': self.pull_file,
-            'push_file': self.push_file
+            'job_status': self.job_status,
+            'push_file': self.push_file,
+            'rename_path': self.rename_path,
+            'delete_path': self.delete_path
         })
 
     def push_file(self, filename, dest_file, dest_uname, dest_ip):
-        proc = subprocess.Popen(['scp', filename, f"{dest_uname}@{dest_ip}:{dest_file}"])
-        push_status = proc.wait()
+        compress = compression.should_compress(filename, dest_ip)
+        push_status = transfer.pool.get(dest_uname, dest_ip).push(filename, dest_file, compress)
         logger.debug("Returned status %s", push_status)
         return push_status
 
-    def pull_file(self, filename, source_uname, source_ip):
-        """Pull file 'filename' from the source."""
+    def pull_file(self, filename, source_uname, source_ip, compress=False):
+        """Start pulling 'filename' from the source in the background and return the job id.
+
+        The transfer is compressed on the wire if the source asks for it. Its outcome is reported
+        to the server with jobs_done, or read back with job_status.
+        """
         my_file = filename.replace("/.tsync", "")
-        my_file = Base.get_dest_path(my_file, self.username, self.role)
-        print("my file is ", my_file)
+        my_file = self.safe_path(Base.get_dest_path(my_file, self.username, self.role))
+        if my_file is None:
+            return False
+        future = self.transfers.submit(source_ip, my_file, self._pull, filename, my_file, source_uname, source_ip,
+                                       compress)
+        return self.jobs.add(future)
+
+    def _pull(self, filename, my_file, source_uname, source_ip, compress):
         self.pulled_files.add(my_file)
-        proc = subprocess.Popen(['scp', f"{source_uname}@{source_ip}:{filename}", my_file])
-        return_status = proc.wait()
-        logger.debug("logging from pull_file of client on filename %s", my_file)
-        logger.debug("Returned status %s", return_status)
+        return_status = transfer.pool.get(source_uname, source_ip).pull(filename, my_file, compress)
+        logger.debug("Pulled %s, returned status %s", my_file, return_status)
+        if return_status != 0:
+            return False
+        self.index.update(my_file)
+        return True
+
+    def job_status(self, job_ids):
+        """Return the state of background jobs: 'running', 'done', 'failed' or 'unknown'."""
+        return self.jobs.status(job_ids)
+
+    def report_jobs(self, results):
+        """Tell the server the outcome of finished pulls, as [job id, ok] pairs."""
+        return sxmlr.jobs_done(self.server_ip, self.server_port, results, self.username, self.ip, self.port) is not None
+
+    def write_file_inline(self, filename, payload, compressed=True):
+        """Write a small file sent by the server, remembering it so the watcher does not push it back."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        self.pulled_files.add(filename)
+        status = super(Client, self).write_file_inline(filename, payload, compressed)
+        if status:
+            self.index.update(filename)
+        return status
+
+    def apply_delta(self, filename, block_size, payload, digest):
+        """Patch a file pulled from the server, remembering it so the watcher does not push it back."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        self.pulled_files.add(filename)
+        status = super(Client, self).apply_delta(filename, block_size, payload, digest)
+        if status:
+            self.index.update(filename, digest)
+        return status
+
+    def finish_chunked(self, filename):
+        """Move a file received in chunks into place, remembering it so the watcher does not push it back."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        self.pulled_files.add(filename)
+        status = super(Client, self).finish_chunked(filename)
+        if status:
+            self.index.update(filename)
+        return status
+
+    def rename_path(self, src, dest, *source):
+        """Apply a rename made on another node, without reporting it back."""
+        src, dest = self.safe_path(src), self.safe_path(dest)
+        if src is None or dest is None:
+            return False
+        self.pulled_files.add(src)
+        if not self.rename_local(src, dest):
+            self.pulled_files.discard(src)
+            return False
+        self.index.move(src, dest)
+        self.mfiles.move(src, dest)
+        return True
+
+    def delete_path(self, path, *source):
+        """Apply a delete made on another node, without reporting it back."""
+        path = self.safe_path(path)
+        if path is None:
+            return False
+        if os.path.isdir(path):
+            for root, dirnames, filenames in os.walk(path):
+                self.pulled_files.update(os.path.join(root, name) for name in dirnames + filenames)
+        self.pulled_files.add(path)
+        if not self.delete_local(path):
+            return False
+        self.index.forget(path)
+        self.mfiles.move(path)
+        return True
 
     def get_public_key(self):
         """Return public key of this client."""
@@ -70,73 +187,461 @@ class Client(Base):
         return pubkey
 
     def find_modified(self):
-        """Find and mark modified files."""
-        last_sync_time = TimeKeeper.get_time()
-        for directory in self.watch_dirs:
-            for root, _, files in os.walk(directory):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    mtime = os.path.getmtime(file_path)
-                    print("mtime is ", mtime, "last sync time is ", last_sync_time)
-                    print("mtime - last_sync_time", mtime - last_sync_time)
-                    if mtime - last_sync_time > 20 and file_path not in self.pulled_files:
-                        print("I am the stupid find modifid", file)
-                        logger.debug("File %s modified in stupid find_modified", file_path)
-                        self.mfiles.add(file_path, mtime)
+        """Find and mark files that changed, and queue deletes made, while the watcher was not running."""
+        changed, deleted = self.index.scan(self.watch_dirs)
+        with self.mfiles.batch():
+            for file_path, mtime in changed:
+                if file_path not in self.pulled_files:
+                    logger.debug("File %s modified since the last scan", file_path)
+                    self.mfiles.add(file_path, mtime)
+            for path in deleted:
+                if path not in self.pulled_files:
+                    logger.debug("%s deleted since the last scan", path)
+                    self.mfiles.move(path)
+                    self.ops.append('delete', path)
+
+    def send_file(self, filename, dest_file, digest):
+        """Transfer one file to the server, as a delta when possible.
+
+        Returns the (size, digest) of the prefix of the file the server is known to hold, or None
+        on failure. An append knows exactly what it sent; the other transfers report the file
+        as it was before they started, which the server has at least, should it keep growing.
+        """
+        appended = self.push_append(filename, dest_file)
+        if appended is not None:
+            return appended
+        sent = self._sent_prefix(filename)
+        if sent is None:
+            return None
+        if sparse.is_sparse(filename):
+            # Chunks that are all hole are skipped, and the server's copy stays sparse; a delta would
+            # read every hole as zeros, on both ends, before sending anything
+            return sent if self.push_chunked(filename, self.server_ip, self.server_port, dest_file, digest) else None
+        if self.push_delta(filename, self.server_ip, self.server_port, dest_file, digest):
+            return sent
+        if self.push_dedup(filename, dest_file, digest):
+            return sent
+        if sent[0] >= chunked.CHUNKED_MIN_SIZE:
+            # Resumable, so an interrupted transfer picks up where it stopped on the next round
+            return sent if self.push_chunked(filename, self.server_ip, self.server_port, dest_file, digest) else None
+        return sent if self.push_file(filename, dest_file, self.server_uname, self.server_ip) == 0 else None
+
+    def push_append(self, filename, dest_file):
+        """Send only the bytes added to 'filename' since it was last synced, if it only grew.
+
+        Returns the (size, digest) the server's copy ends up with, or None whenever the caller should
+        fall back to another transfer. The last call carries the digest of the whole file, which the
+        server checks before accepting the append.
+        """
+        appended = self.index.appended(filename)
+        if appended is None:
+            return None
+        start, digest = appended
+        offset = start
+        compress = compression.should_compress(filename)
+        try:
+            with open(filename, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                fp.seek(offset)
+                logger.debug("%s grew from %d to %d bytes, sending the tail", filename, offset, size)
+                while offset < size:
+                    data = fp.read(min(chunked.CHUNK_SIZE, size - offset))
+                    if not data:
+                        # Truncated while we read it
+                        return None
+                    digest.update(data)
+                    final = digest.hexdigest() if offset + len(data) == size else None
+                    payload, compressed = compression.pack(data, compress, self.server_ip)
+                    status = sxmlr.append_file(self.server_ip, self.server_port, dest_file, str(start), str(offset),
+                                               xmlrpc.client.Binary(payload), compressed, final)
+                    if status is not True:
+                        return None
+                    offset += len(data)
+        except OSError as e:
+            logger.error("Error reading %s: %s", filename, e)
+            return None
+        return offset, digest.hexdigest()
+
+    def push_dedup(self, filename, dest_file, digest):
+        """Send only the content-defined chunks of 'filename' the server's chunk store lacks.
+
+        Returns False whenever the caller should fall back to another transfer, including when the
+        server shares none of the first chunks of the file, which is checked before chunking the rest.
+        """
+        try:
+            if not chunkstore.DEDUP_MIN_SIZE <= os.path.getsize(filename) <= chunkstore.DEDUP_MAX_SIZE:
+                return False
+            chunks = chunkstore.file_chunks(filename, limit=chunkstore.DEDUP_PROBE_SIZE)
+            probe = {chunk for _, _, chunk in chunks}
+            probe_missing = sxmlr.missing_chunks(self.server_ip, self.server_port, sorted(probe))
+            if not isinstance(probe_missing, list) or len(probe_missing) == len(probe):
+                return False
+            chunks += chunkstore.file_chunks(filename, start=sum(length for _, length, _ in chunks))
+        except (OSError, ValueError):
+            return False
+        recipe = [chunk for _, _, chunk in chunks]
+        unique = set(recipe)
+        missing = sxmlr.missing_chunks(self.server_ip, self.server_port, sorted(unique - probe))
+        if not isinstance(missing, list):
+            return False
+        missing += probe_missing
+        logger.debug("Server lacks %d of %d chunks of %s", len(missing), len(unique), filename)
+        missing = set(missing)
+        compress = compression.should_compress(filename)
+        batch, batch_bytes = [], 0
+        try:
+            with open(filename, 'rb') as fp:
+                for offset, length, chunk in chunks:
+                    if chunk not in missing:
+                        continue
+                    missing.discard(chunk)
+                    fp.seek(offset)
+                    payload, compressed = compression.pack(fp.read(length), compress, self.server_ip)
+                    batch.append([chunk, xmlrpc.client.Binary(payload), compressed])
+                    batch_bytes += len(payload)
+                    if batch_bytes >= chunkstore.PUT_BATCH_BYTES:
+                        if sxmlr.put_chunks(self.server_ip, self.server_port, batch) is not True:
+                            return False
+                        batch, batch_bytes = [], 0
+        except OSError as e:
+            logger.error("Error reading %s: %s", filename, e)
+            return False
+        if batch and sxmlr.put_chunks(self.server_ip, self.server_port, batch) is not True:
+            return False
+        return sxmlr.assemble_file(self.server_ip, self.server_port, dest_file, recipe, digest) is True
+
+    def push_ops(self):
+        """Send queued renames and deletes to the server in order.
+
+        Returns False if the server could not be reached, leaving the rest queued.
+        """
+        for seq, op in self.ops.list():
+            if op[0] == 'rename':
+                status = sxmlr.rename_path(self.server_ip, self.server_port, op[1], op[2], self.username, self.ip,
+                                           self.port)
+            else:
+                status = sxmlr.delete_path(self.server_ip, self.server_port, op[1], self.username, self.ip,
+                                           self.port)
+            if status is None:
+                logger.error("Failed to send %s of %s to the server", op[0], op[1])
+                return False
+            if op[0] == 'rename' and status is True:
+                self.index.move(op[1], op[2])
+            elif op[0] == 'rename':
+                # The server could not rename its copy; send the content under the new name instead
+                logger.debug("Server refused rename of %s, re-sending %s", op[1], op[2])
+                self.index.forget(op[1])
+                self.queue_tree(op[2])
+            else:
+                self.index.forget(op[1])
+            self.ops.remove(seq)
+        return True
+
+    def reconcile(self):
+        """Compare the local tree with the server mirror and queue whatever differs.
+
+        Only directories whose hashes differ are compared, one level of them per RPC. A file that
+        differs is pushed if it changed here since it was last synced, and fetched otherwise; a
+        file the server no longer has is left alone if it has not changed since it was synced, as
+        the server deleted it. Runs only once the server has sent every logged change, so deletes
+        and renames still in flight are not undone. Returns False if it should be retried soon.
+        """
+        if sxmlr.caught_up(self.server_ip, self.server_port, self.username, self.ip, self.port) is not True:
+            logger.debug("Not caught up with the server yet, postponing reconcile")
+            return False
+        self.tree.refresh()
+        frontier = ['']
+        push, fetch = [], []
+        compared = 0
+        while frontier:
+            remote = sxmlr.tree_nodes(self.server_ip, self.server_port, frontier)
+            if not isinstance(remote, list):
+                logger.error("Failed to get tree nodes from the server")
+                return False
+            remote = {rel: (node_hash, children) for rel, node_hash, children in remote}
+            compared += len(frontier)
+            next_frontier = []
+            for rel in frontier:
+                local = self.tree.node(rel)
+                theirs = remote.get(rel)
+                if local is not None and theirs is not None and local.hash == theirs[0]:
+                    continue
+                my_children = local.children if local is not None else {}
+                their_children = theirs[1] if theirs is not None else {}
+                for name in set(my_children) | set(their_children):
+                    mine = my_children.get(name)
+                    other = tuple(their_children[name]) if name in their_children else None
+                    if mine == other:
+                        continue
+                    child = os.path.join(rel, name) if rel else name
+                    path = os.path.join(self.tree.base, child)
+                    synced = mine is not None and mine[0] == 'f' and mine[1] == self.index.synced_digest(path)
+                    action = compare_child(mine, other, synced)
+                    if action == 'descend':
+                        next_frontier.append(child)
+                    elif action == 'push':
+                        push.append(path)
+                    elif action == 'fetch':
+                        fetch.append(child)
+                    else:
+                        logger.debug("%s was deleted on the server, not pushing it back", path)
+            frontier = next_frontier
+        logger.info("Reconcile compared %d directories: %d paths to push, %d to fetch", compared, len(push),
+                    len(fetch))
+        for path in push:
+            self.queue_tree(path)
+        if fetch and sxmlr.resend_paths(self.server_ip, self.server_port, fetch, self.username, self.ip,
+                                        self.port) is not True:
+            logger.error("Failed to ask the server to resend %d paths", len(fetch))
+            return False
+        return True
+
+    def queue_tree(self, path):
+        """Queue a file, or every file below a directory, for pushing."""
+        paths = [path] if not os.path.isdir(path) else \
+            [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        with self.mfiles.batch():
+            for file_path in paths:
+                try:
+                    self.mfiles.add(file_path, os.path.getmtime(file_path))
+                except OSError:
+                    pass
 
     def sync_files(self):
         """Sync all the files present in the mfiles set and push this set."""
         while True:
             try:
-                time.sleep(10)
-                for filedata in self.mfiles.list():
-                    filename = filedata.name
-                    logger.info("Attempting to push file: %s", filename)
-                    dest_file = sxmlr.req_push_file(self.server_ip, self.server_port, filedata, self.username, self.ip,
-                                                    self.port)
-                    logger.debug("Destination file path received: %s", dest_file)
-                    if dest_file is None:
-                        logger.error("Failed to get destination file path for %s", filename)
-                        break
-                    push_status = self.push_file(filename, dest_file, self.server_uname, self.server_ip)
-                    logger.debug("Push file status for %s: %s", filename, push_status)
-                    if push_status < 0:
-                        logger.error("Failed to push file %s", filename)
+                # Sleep until the watcher queues something; while files are left over from a failed
+                # round, also wake up periodically to retry them
+                self.work_ready.wait(SYNC_RETRY_INTERVAL if len(self.mfiles) or len(self.ops) else
+                                     max(0, self.next_reconcile - time.monotonic()))
+                self.work_ready.clear()
+                time.sleep(SYNC_BATCH_WINDOW)
+                # Renames and deletes go first so pushed files land under their current names
+                if not self.push_ops():
+                    continue
+                pending = self.mfiles.list()
+                # A large backlog, such as a new client's whole tree, is seeded as streamed archives
+                seeding = len(pending) >= SEED_MIN_FILES
+                batch_size = SEED_BATCH_SIZE if seeding else SYNC_BATCH_SIZE
+                for start in range(0, len(pending), batch_size):
+                    if not self.sync_batch(pending[start:start + batch_size], seeding):
                         break
-                    rpc_status = sxmlr.ack_push_file(self.server_ip, self.server_port, dest_file, self.username,
-                                                     self.ip, self.port)
-                    logger.debug("Acknowledgement status for file %s: %s", dest_file, rpc_status)
-                    if rpc_status is None:
-                        logger.error("Failed to get acknowledgement for file %s", dest_file)
-                        break
-                    self.mfiles.remove(filename)
-                    logger.info("Successfully synced and removed file: %s", filename)
                 self.mfiles.update_modified_timestamp()
-                TimeKeeper.update_time()
+                logger.debug("Compression stats: %s", compression.stats.report())
+                if time.monotonic() >= self.next_reconcile:
+                    reconciled = self.reconcile()
+                    self.next_reconcile = time.monotonic() + (RECONCILE_INTERVAL if reconciled else
+                                                              SYNC_RETRY_INTERVAL)
             except KeyboardInterrupt:
                 break
 
+    def sync_batch(self, batch, seeding=False):
+        """Push a batch of queued files: small ones inline in one RPC, the rest through a manifest.
+
+        When seeding, every file goes through the manifest and travels in a single archive.
+        Returns False if the batch could not be completed and syncing should stop for this round.
+        """
+        synced = []  # (filedata, digest, sent prefix or None) of files that need no further work
+        small, large = [], []
+        for filedata in batch:
+            filename = filedata.name
+            try:
+                digest = self.hashes.digest(filename)
+                size = os.path.getsize(filename)
+            except OSError:
+                logger.debug("File %s is gone, dropping it from the queue", filename)
+                self.mfiles.remove(filename, filedata.time)
+                continue
+            if digest == self.index.synced_digest(filename):
+                logger.debug("Content of %s unchanged since last sync, skipping", filename)
+                synced.append((filedata, digest, None))
+                continue
+            if size <= INLINE_MAX_SIZE and not seeding:
+                small.append((filedata, digest))
+            else:
+                large.append((filedata, digest))
+
+        completed = True
+        if small:
+            done, completed = self.push_inline(small)
+            synced.extend(done)
+        if large:
+            done, ok = self.push_manifest(large, archive=seeding)
+            synced.extend(done)
+            completed = completed and ok
+
+        with self.mfiles.batch(), self.index.batch():
+            for filedata, digest, sent in synced:
+                self.mfiles.remove(filedata.name, filedata.time)
+                self.index.update(filedata.name, digest, sent)
+        logger.info("Successfully synced %d files", len(synced))
+        return completed
+
+    def push_inline(self, entries):
+        """Send small files with their contents, compressed if worthwhile, inside a single RPC.
+
+        The server writes and acknowledges them in the same call. Returns (filedata, digest, sent
+        prefix) for the files that made it and whether all of them did.
+        """
+        sent, payloads = [], []
+        for filedata, digest in entries:
+            try:
+                with open(filedata.name, 'rb') as fp:
+                    data = fp.read()
+            except OSError as e:
+                logger.error("Error reading %s: %s", filedata.name, e)
+                continue
+            sent.append((filedata, digest, (len(data), delta.data_digest(data))))
+            payload, compressed = compression.pack(data, compression.compressible_type(filedata.name),
+                                                   self.server_ip)
+            payloads.append([dict(filedata.to_dict(), digest=digest), xmlrpc.client.Binary(payload), compressed])
+        if not payloads:
+            return [], True
+        logger.info("Pushing %d small files inline", len(payloads))
+        results = sxmlr.push_files_inline(self.server_ip, self.server_port, payloads, self.username, self.ip,
+                                          self.port)
+        if not isinstance(results, list):
+            logger.error("Failed to push %d small files inline", len(payloads))
+            return [], False
+        done = [entry for entry, result in zip(sent, results) if result is not False]
+        return done, len(done) == len(entries)
+
+    def push_manifest(self, entries, archive=False):
+        """Request destinations for a manifest of files, transfer them and acknowledge them together.
+
+        With 'archive', the files are streamed to the server as one tar archive instead of one
+        transfer each. Returns (filedata, digest, sent prefix) for the files that made it and whether
+        all of them did.
+        """
+        done = []
+        manifest = [dict(filedata.to_dict(), digest=digest) for filedata, digest in entries]
+        logger.info("Requesting push of %d files", len(manifest))
+        dest_files = sxmlr.req_push_files(self.server_ip, self.server_port, manifest, self.username, self.ip,
+                                          self.port)
+        if not isinstance(dest_files, list):
+            logger.error("Failed to get destination file paths for %d files", len(manifest))
+            return done, False
+
+        to_send = []
+        refused = False
+        for (filedata, digest), dest_file in zip(entries, dest_files):
+            if dest_file is False:
+                logger.error("Server refused a destination for %s", filedata.name)
+                refused = True
+                continue
+            if dest_file == UP_TO_DATE:
+                logger.debug("Server already has the content of %s", filedata.name)
+                done.append((filedata, digest, None))
+                continue
+            to_send.append((filedata, digest, dest_file))
+
+        if archive:
+            # Very large files still go on their own, where an interruption does not restart them
+            huge = [entry for entry in to_send if self._size(entry[0].name) >= chunked.CHUNKED_MIN_SIZE]
+            pushed, completed = self.push_archive([entry for entry in to_send if entry not in huge])
+            if huge:
+                pushed_huge, completed_huge = self.push_each(huge)
+                pushed = pushed + pushed_huge
+                completed = completed and completed_huge
+        else:
+            pushed, completed = self.push_each(to_send)
+
+        if pushed:
+            rpc_status = sxmlr.ack_push_files(self.server_ip, self.server_port,
+                                              [dest_file for _, _, dest_file, _ in pushed], self.username,
+                                              self.ip, self.port)
+            logger.debug("Acknowledgement status for %d files: %s", len(pushed), rpc_status)
+            if rpc_status is None:
+                logger.error("Failed to get acknowledgement for %d files", len(pushed))
+                return done, False
+            done.extend((filedata, digest, sent) for filedata, digest, _, sent in pushed)
+        return done, completed and not refused
+
+    @staticmethod
+    def _size(filename):
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def _sent_prefix(self, filename):
+        """Return the (size, digest) of a file about to be sent, or None if it cannot be read.
+
+        The digest comes from the hash cache unless the file grows while it is hashed, in which
+        case only the bytes it had before are hashed.
+        """
+        try:
+            size = os.path.getsize(filename)
+            digest = self.hashes.digest(filename)
+            if os.path.getsize(filename) != size:
+                digest = delta.prefix_hash(filename, size).hexdigest()
+            return size, digest
+        except (OSError, ValueError) as e:
+            logger.error("Error reading %s: %s", filename, e)
+            return None
+
+    def push_each(self, to_send):
+        """Transfer (filedata, digest, dest_file) entries on the worker pool, one transfer per file.
+
+        Returns the entries that were transferred, each with the prefix the server got, and whether
+        all of them were.
+        """
+        jobs = [(entry, self.transfers.submit(self.server_ip, entry[2], self.send_file, entry[0].name, entry[2],
+                                              entry[1]))
+                for entry in to_send]
+        completed = True
+        pushed = []
+        for entry, future in jobs:
+            try:
+                sent = future.result()
+            except Exception:
+                sent = None
+            logger.debug("Pushed %s: %s", entry[0].name, sent)
+            if sent is None:
+                logger.error("Failed to push file %s", entry[0].name)
+                completed = False
+                continue
+            pushed.append(entry + (sent,))
+        return pushed, completed
+
+    def push_archive(self, to_send):
+        """Stream (filedata, digest, dest_file) entries to the server as a single archive.
+
+        Returns the entries that were transferred, each with the prefix the server got, and whether
+        all of them were.
+        """
+        if not to_send:
+            return [], True
+        logger.info("Seeding %d files to the server as one archive", len(to_send))
+        prefixes = [self._sent_prefix(filedata.name) for filedata, _, _ in to_send]
+        compress = compression.should_compress_batch([filedata.name for filedata, _, _ in to_send], self.server_ip)
+        status = transfer.pool.get(self.server_uname, self.server_ip).push_archive(
+            [(filedata.name, dest_file) for filedata, _, dest_file in to_send], compress)
+        if status != 0:
+            logger.error("Failed to stream archive of %d files, status %s", len(to_send), status)
+            return [], False
+        return [entry + (sent,) for entry, sent in zip(to_send, prefixes) if sent is not None], True
+
     def watch_files(self):
-        """Keep a watch on files present in sync directories."""
+        """Keep a watch on files present in sync directories and their subdirectories."""
         try:
             wm = WatchManager()
             mask = EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_CREATE'] | \
                    EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_DELETE'] | \
-                   EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MODIFY']
-            notifier = Notifier(wm, Filewatcher(self.mfiles, self.rfiles, self.pulled_files))
+                   EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MODIFY'] | \
+                   EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_CLOSE_WRITE'] | \
+                   EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MOVED_FROM'] | \
+                   EventsCodes.FLAG_COLLECTIONS['OP_FLAGS']['IN_MOVED_TO']
+            notifier = Notifier(wm, Filewatcher(self.mfiles, self.ops, self.pulled_files))
 
             logger.debug("Watched directories %s", self.watch_dirs)
             for watch_dir in self.watch_dirs:
-                wm.add_watch(os.path.expanduser(watch_dir), mask, rec=False, auto_add=True)
-            while True:
-                try:
-                    time.sleep(5)
-                    notifier.process_events()
-                    if notifier.check_events():
-                        notifier.read_events()
-                except KeyboardInterrupt:
-                    notifier.stop()
-                    break
+                # With auto_add, pyinotify also replays IN_CREATE for entries made in a new
+                # directory before its watch was in place, so that window is not lost.
+                wm.add_watch(os.path.expanduser(watch_dir), mask, rec=True, auto_add=True)
+            # Block on the inotify fd until events arrive; returns on KeyboardInterrupt
+            notifier.loop()
         except Exception as e:
             logger.error("Exception occurred in watch_files: %s", str(e))
             raise
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+import time
+import zlib
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Bytes read from a file to estimate how well it compresses
+SAMPLE_SIZE = 64 * 1024
+# Compress only if the sample shrinks to less than this fraction of its size
+MAX_RATIO = 0.9
+# Fast zlib level used both for sampling and for payloads we compress ourselves
+LEVEL = 1
+
+# Formats that are already compressed; sampling them is a waste of time
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.apk', '.avi', '.bz2', '.deb', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg',
+    '.lz4', '.lzma', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.opus', '.pdf', '.png', '.pptx',
+    '.rar', '.rpm', '.tgz', '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+
+class CompressionStats:
+    """Per-peer totals of bytes before and after compression and CPU time spent deciding and compressing.
+
+    Peers are keyed by IP address on every send path, so all transfers to a host add up in one place.
+    Transfers compressed by ssh only contribute an estimate derived from the sample.
+    """
+
+    def __init__(self):
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def record(self, peer, raw_bytes, wire_bytes, cpu_seconds, compressed):
+        with self.lock:
+            totals = self.peers.setdefault(peer, {'transfers': 0, 'compressed': 0, 'raw_bytes': 0,
+                                                  'wire_bytes': 0, 'cpu_seconds': 0.0})
+            totals['transfers'] += 1
+            totals['compressed'] += int(compressed)
+            totals['raw_bytes'] += raw_bytes
+            totals['wire_bytes'] += wire_bytes
+            totals['cpu_seconds'] += cpu_seconds
+
+    def report(self):
+        """Return {peer: totals} including bytes saved, in a form XML-RPC can marshal."""
+        with self.lock:
+            return {str(peer): dict(totals, bytes_saved=str(totals['raw_bytes'] - totals['wire_bytes']),
+                                    raw_bytes=str(totals['raw_bytes']), wire_bytes=str(totals['wire_bytes']))
+                    for peer, totals in self.peers.items()}
+
+
+stats = CompressionStats()
+
+
+def _ratio(data):
+    if not data:
+        return 1.0
+    return len(zlib.compress(data, LEVEL)) / len(data)
+
+
+def compressible_type(path):
+    """Return False for a file in a format that is already compressed, judged by its extension."""
+    return os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def should_compress(path, peer=None):
+    """Decide whether a transfer of 'path' is worth compressing, from its type and a sample.
+
+    When 'peer' is given, the decision and its estimated savings are added to the stats.
+    """
+    start = time.thread_time()
+    compress = False
+    ratio = 1.0
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        if compressible_type(path):
+            with open(path, 'rb') as fp:
+                sample = fp.read(SAMPLE_SIZE)
+                if size > 2 * SAMPLE_SIZE:
+                    # Files often start with headers unlike the rest; take a second sample mid-file
+                    fp.seek(size // 2)
+                    sample += fp.read(SAMPLE_SIZE)
+            ratio = _ratio(sample)
+            compress = ratio < MAX_RATIO
+    except OSError as e:
+        logger.debug("Cannot sample %s for compression: %s", path, e)
+    if peer is not None:
+        stats.record(peer, size, int(size * ratio) if compress else size, time.thread_time() - start, compress)
+    logger.debug("Compression for %s: %s (sample ratio %.2f)", path, compress, ratio)
+    return compress
+
+
+def should_compress_batch(paths, peer=None):
+    """Decide whether one stream of many files is worth compressing.
+
+    Each file is judged as by should_compress; the stream is compressed only if the compressible
+    ones make up most of its bytes, so media-heavy batches go out as they are.
+    """
+    total = compressible = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        total += size
+        if should_compress(path, peer):
+            compressible += size
+    return compressible * 2 > total
+
+
+def pack(data, compress, peer=None):
+    """Return (payload, compressed) for data sent inside an RPC.
+
+    'compress' is the caller's decision for the whole file, from should_compress or, for a small
+    file, compressible_type. Without it the data is not even tried; with it, data that does not
+    shrink enough is still sent as it is.
+    """
+    start = time.thread_time()
+    payload, compressed = data, False
+    if compress:
+        packed = zlib.compress(data, LEVEL)
+        if len(packed) < MAX_RATIO * len(data):
+            payload, compressed = packed, True
+    if peer is not None:
+        stats.record(peer, len(data), len(payload), time.thread_time() - start, compressed)
+    return payload, compressed
+
+
+def unpack(payload, compressed):
+    """Reverse pack()."""
+    return zlib.decompress(payload) if compressed else payload
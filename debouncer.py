@@ -0,0 +1,92 @@
+import heapq
+import logging
+import threading
+import time
+
+from paths import moved_path
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+
+class Debouncer:
+    """Release each path to a callback once it has gone quiet for a settle time.
+
+    Touching a path that is already pending pushes its release back, so a burst of events on
+    one file produces a single callback. Callers never block on the delay.
+    """
+
+    def __init__(self, callback, settle_time):
+        self.callback = callback
+        self.settle_time = settle_time
+        self.deadlines = {}  # path -> time at which it is released
+        self.heap = []  # (deadline, path), possibly earlier than the deadline in self.deadlines
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the release thread."""
+        self.thread.start()
+
+    def touch(self, path, delay=None):
+        """Schedule 'path' for release after 'delay' seconds (the settle time by default)."""
+        deadline = time.monotonic() + (self.settle_time if delay is None else delay)
+        with self.cond:
+            pending = self.deadlines.get(path)
+            self.deadlines[path] = deadline
+            # A later deadline is picked up lazily when the earlier heap entry comes due
+            if pending is None or deadline < pending:
+                heapq.heappush(self.heap, (deadline, path))
+                self.cond.notify()
+
+    def cancel(self, path):
+        """Forget a pending path."""
+        with self.cond:
+            self.deadlines.pop(path, None)
+
+    def move(self, src, dest=None):
+        """Carry pending paths at or under 'src' over to 'dest', or forget them if 'dest' is None."""
+        with self.cond:
+            for path in [path for path in self.deadlines if moved_path(path, src, dest or src)]:
+                deadline = self.deadlines.pop(path)
+                if dest is not None:
+                    new_path = moved_path(path, src, dest)
+                    self.deadlines[new_path] = deadline
+                    heapq.heappush(self.heap, (deadline, new_path))
+            self.cond.notify()
+
+    def pending(self):
+        """Return the number of paths waiting to settle."""
+        with self.cond:
+            return len(self.deadlines)
+
+    def _next_due(self):
+        """Wait for the next path whose deadline has passed and return it."""
+        with self.cond:
+            while True:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, path = self.heap[0]
+                current = self.deadlines.get(path)
+                if current is None or current < deadline:
+                    heapq.heappop(self.heap)  # cancelled, or superseded by an earlier entry
+                    continue
+                if current > deadline:
+                    heapq.heapreplace(self.heap, (current, path))
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self.cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                del self.deadlines[path]
+                return path
+
+    def _run(self):
+        while True:
+            path = self._next_due()
+            try:
+                self.callback(path)
+            except Exception as e:
+                logger.error("Error releasing %s: %s", path, e)
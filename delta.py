@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import sparse
+from paths import TEMP_PREFIX
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 128 * 1024
+# Files smaller than this are cheaper to copy whole than to diff
+DELTA_MIN_SIZE = 64 * 1024
+# Give up on the delta once this many literal bytes have piled up
+DELTA_MAX_LITERAL = 64 * 1024 * 1024
+# Past the first DELTA_PROBE_SIZE bytes, also give up once literals make up more than this
+# share of what was scanned; encoding is slow, so a mostly rewritten file is cheaper sent whole
+DELTA_PROBE_SIZE = 2 * 1024 * 1024
+DELTA_MAX_LITERAL_RATIO = 0.5
+# Hash files at least this big through mmap
+MMAP_MIN_SIZE = 1024 * 1024
+
+ADLER_MOD = 65521
+STRONG_SIZE = 16
+SIG_RECORD = struct.Struct('>I16s')
+COPY_RECORD = struct.Struct('>cII')
+DATA_HEADER = struct.Struct('>cI')
+
+
+def block_size_for(size):
+    """Pick a block size close to the square root of the file size."""
+    block_size = int(size ** 0.5) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_sum(block):
+    """Return the strong checksum of a block."""
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+def file_digest(path):
+    """Return the hex digest of a whole file.
+
+    Large files are hashed straight from an mmap, without copying them through read buffers.
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size >= MMAP_MIN_SIZE:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+        else:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prefix_hash(path, length):
+    """Return the hash of the first 'length' bytes of a file, as file_digest would hash them.
+
+    The hash object is returned rather than its digest so the caller can extend it over what follows.
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fp:
+        remaining = length
+        while remaining:
+            chunk = fp.read(min(1024 * 1024, remaining))
+            if not chunk:
+                raise ValueError(f"{path} is shorter than {length} bytes")
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+def data_digest(data):
+    """Return the hex digest of content held in memory, as file_digest computes it from a file."""
+    return hashlib.blake2b(data).hexdigest()
+
+
+def file_signature(path, block_size=None):
+    """Return (block_size, signature) for the basis file at 'path', or None if it cannot be read.
+
+    The signature is a packed sequence of (weak adler32, strong hash) records, one per block.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if block_size is None:
+        block_size = block_size_for(size)
+    records = []
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            records.append(SIG_RECORD.pack(zlib.adler32(block), strong_sum(block)))
+    return block_size, b''.join(records)
+
+
+def _parse_signature(signature):
+    """Map each weak checksum to the list of (block index, strong hash) sharing it."""
+    table = {}
+    for index, (weak, strong) in enumerate(SIG_RECORD.iter_unpack(signature)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+
+def _roll(weak, out_byte, in_byte, block_size):
+    """Slide an adler32 window one byte forward."""
+    a = weak & 0xffff
+    b = weak >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+class _DeltaWriter:
+    """Accumulate copy and literal instructions, merging runs as they come."""
+
+    def __init__(self):
+        self.out = bytearray()
+        self.literal = bytearray()
+        self.literal_total = 0
+        self.run_start = None
+        self.run_length = 0
+
+    def copy(self, index):
+        self._flush_literal()
+        if self.run_start is not None and self.run_start + self.run_length == index:
+            self.run_length += 1
+            return
+        self._flush_run()
+        self.run_start, self.run_length = index, 1
+
+    def data(self, chunk):
+        self._flush_run()
+        self.literal += chunk
+        self.literal_total += len(chunk)
+
+    def _flush_run(self):
+        if self.run_start is not None:
+            self.out += COPY_RECORD.pack(b'C', self.run_start, self.run_length)
+            self.run_start = None
+
+    def _flush_literal(self):
+        if self.literal:
+            self.out += DATA_HEADER.pack(b'D', len(self.literal))
+            self.out += self.literal
+            self.literal = bytearray()
+
+    def getvalue(self):
+        self._flush_run()
+        self._flush_literal()
+        return zlib.compress(bytes(self.out), 1)
+
+
+def compute_delta(path, block_size, signature, max_literal=DELTA_MAX_LITERAL, probe_size=DELTA_PROBE_SIZE,
+                  max_literal_ratio=DELTA_MAX_LITERAL_RATIO):
+    """Encode 'path' as copy/literal instructions against a basis described by 'signature'.
+
+    Returns the compressed delta, or None if more than 'max_literal' bytes would have to be sent
+    or, once 'probe_size' bytes have been scanned, literals exceed 'max_literal_ratio' of them.
+    """
+    def too_literal(scanned):
+        if writer.literal_total > max_literal or \
+                (scanned >= probe_size and writer.literal_total > scanned * max_literal_ratio):
+            logger.debug("Delta for %s has %d literal bytes after %d scanned, giving up", path,
+                         writer.literal_total, scanned)
+            return True
+        return False
+
+    table = _parse_signature(signature)
+    writer = _DeltaWriter()
+    size = os.path.getsize(path)
+    if size == 0:
+        return writer.getvalue()
+
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = 0
+        literal_start = 0
+        weak = None
+        while pos < size:
+            length = min(block_size, size - pos)
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + length])
+            match = None
+            candidates = table.get(weak)
+            if candidates:
+                strong = strong_sum(data[pos:pos + length])
+                for index, candidate in candidates:
+                    if candidate == strong:
+                        match = index
+                        break
+            if match is not None:
+                if literal_start < pos:
+                    writer.data(data[literal_start:pos])
+                    if too_literal(pos):
+                        return None
+                writer.copy(match)
+                pos += length
+                literal_start = pos
+                weak = None
+            elif pos + length < size:
+                weak = _roll(weak, data[pos], data[pos + length], length)
+                pos += 1
+            else:
+                # Only a full-length window can roll; the unmatched tail goes out as literal data
+                break
+            # The literal count only grows here and above, so that is where it is checked
+            if pos - literal_start >= MAX_BLOCK_SIZE:
+                writer.data(data[literal_start:pos])
+                literal_start = pos
+                if too_literal(pos):
+                    return None
+        if literal_start < size:
+            writer.data(data[literal_start:size])
+    return writer.getvalue()
+
+
+def apply_delta(basis_path, delta, block_size, out_path, digest=None):
+    """Rebuild 'out_path' from the basis file and a delta produced by compute_delta.
+
+    The new file is written next to 'out_path' and moved into place only once complete and,
+    when 'digest' is given, only if its contents hash to it.
+    """
+    raw = zlib.decompress(delta)
+    hasher = hashlib.blake2b()
+    out_dir = os.path.dirname(out_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX + 'delta-', dir=out_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(basis_path, 'rb') as basis:
+            pos = 0
+            while pos < len(raw):
+                kind = raw[pos:pos + 1]
+                if kind == b'C':
+                    _, start, count = COPY_RECORD.unpack_from(raw, pos)
+                    pos += COPY_RECORD.size
+                    basis.seek(start * block_size)
+                    remaining = count * block_size
+                    while remaining > 0:
+                        chunk = basis.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            break
+                        sparse.write_sparse(out, chunk)
+                        hasher.update(chunk)
+                        remaining -= len(chunk)
+                elif kind == b'D':
+                    _, length = DATA_HEADER.unpack_from(raw, pos)
+                    pos += DATA_HEADER.size
+                    chunk = raw[pos:pos + length]
+                    sparse.write_sparse(out, chunk)
+                    hasher.update(chunk)
+                    pos += length
+                else:
+                    raise ValueError(f"Corrupt delta record {kind!r} at offset {pos}")
+            # Zero blocks were skipped to keep them as holes; a trailing one still sets the size
+            out.truncate()
+        if digest is not None and hasher.hexdigest() != digest:
+            raise ValueError(f"Rebuilt {out_path} does not match the sender's digest")
+        shutil.copymode(basis_path, tmp_path)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,177 @@
+import logging
+import os
+from collections import namedtuple
+
+import delta
+from paths import moved_path
+from persistence import PersistentDict
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+FileEntry = namedtuple('FileEntry', ['ino', 'size', 'mtime_ns', 'digest', 'synced_ino', 'synced_size'],
+                       defaults=(None, None))
+DirEntry = namedtuple('DirEntry', ['mtime_ns', 'names'])
+
+
+class FileIndex(PersistentDict):
+    """Persistent path -> metadata index of the watch dirs, used to find changes between runs.
+
+    Files map to FileEntry and directories to DirEntry(mtime_ns, names). A FileEntry holds the
+    current (ino, size, mtime_ns) and, for the content last synced, its digest, inode and size;
+    these are None until the file is first synced.
+    """
+
+    def __init__(self, pkl_filename, hashes=None):
+        self.hashes = hashes
+        super().__init__(pkl_filename)
+
+    def _forget(self, path):
+        """Drop a path and, for a directory, everything recorded below it.
+
+        Returns True if a file among them had been synced.
+        """
+        entry = self.set.get(path)
+        if entry is None:
+            return False
+        synced = isinstance(entry, FileEntry) and entry.digest is not None
+        if isinstance(entry, DirEntry):
+            for name in entry.names:
+                synced = self._forget(os.path.join(path, name)) or synced
+        self._delete(path)
+        return synced
+
+    def _digest(self, path):
+        """Hash a file, through the hash cache when there is one."""
+        if self.hashes is not None:
+            return self.hashes.digest(path)
+        return delta.file_digest(path)
+
+    def get(self, path):
+        """Return the entry recorded for 'path', or None."""
+        return self.set.get(path)
+
+    def synced_digest(self, path):
+        """Return the digest of 'path' as it was last synced, or None."""
+        entry = self.set.get(path)
+        if isinstance(entry, FileEntry):
+            return entry.digest
+        return None
+
+    def update(self, path, digest=None, sent=None):
+        """Record the state of a file that has just been synced.
+
+        'sent' is the (size, digest) of the prefix the peer got, when the file may have grown since;
+        by default the file is taken to have been synced as it is now.
+        """
+        try:
+            st = os.stat(path)
+            if sent is not None:
+                synced_size, digest = sent
+            else:
+                synced_size = st.st_size
+                if digest is None:
+                    digest = self._digest(path)
+        except OSError:
+            return
+        # A file that grew past what was sent must look changed to the next scan
+        with self.lock:
+            self._put(path, FileEntry(st.st_ino, synced_size, st.st_mtime_ns, digest, st.st_ino, synced_size))
+
+    def appended(self, path):
+        """Return (synced size, prefix hash) if 'path' only grew since it was synced, else None.
+
+        The file must be the same inode, be larger, and still hash its whole synced prefix to the
+        synced digest. The hash of that prefix is returned for the caller to extend over the rest.
+        """
+        entry = self.get(path)
+        if not isinstance(entry, FileEntry) or entry.digest is None or entry.synced_size is None:
+            return None
+        try:
+            st = os.stat(path)
+            if st.st_ino != entry.synced_ino or st.st_size <= entry.synced_size:
+                return None
+            prefix = delta.prefix_hash(path, entry.synced_size)
+        except (OSError, ValueError):
+            return None
+        if prefix.hexdigest() != entry.digest:
+            return None
+        return entry.synced_size, prefix
+
+    def move(self, src, dest):
+        """Carry the entries at or under 'src' over to 'dest' after a rename."""
+        with self.batch():
+            for path in [path for path in self.set if moved_path(path, src, dest)]:
+                entry = self.set[path]
+                self._delete(path)
+                self._put(moved_path(path, src, dest), entry)
+
+    def forget(self, path):
+        """Drop the entries at or under a deleted path."""
+        with self.lock:
+            self._forget(path)
+
+    def _file_changed(self, path, st):
+        """Compare a file against its entry, recording its new stat. Return True if it changed."""
+        entry = self.set.get(path)
+        if isinstance(entry, FileEntry) and (entry.ino, entry.size, entry.mtime_ns) == \
+                (st.st_ino, st.st_size, st.st_mtime_ns):
+            return False
+        synced_digest = entry.digest if isinstance(entry, FileEntry) else None
+        if synced_digest is not None and entry.size == st.st_size:
+            # Same size but touched: only the content can tell whether it really changed
+            try:
+                digest = self._digest(path)
+            except OSError:
+                return False
+            if digest == synced_digest:
+                self._put(path, entry._replace(ino=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns))
+                return False
+        # Keep what is known of the last synced content until the new one has been synced
+        if isinstance(entry, FileEntry):
+            self._put(path, entry._replace(ino=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns))
+        else:
+            self._put(path, FileEntry(st.st_ino, st.st_size, st.st_mtime_ns, None))
+        return True
+
+    def scan(self, roots):
+        """Walk 'roots' and return the files that are new or have changed and the paths that vanished.
+
+        Changed files come as (path, mtime). Vanished paths are only those that had been synced,
+        or held a synced file, as the peer has a copy of them to delete.
+        """
+        changed, deleted = [], []
+        with self.batch():
+            stack = list(roots)
+            while stack:
+                directory = stack.pop()
+                try:
+                    dir_st = os.stat(directory)
+                except OSError:
+                    self._forget(directory)
+                    continue
+                entry = self.set.get(directory)
+                names = []
+                try:
+                    with os.scandir(directory) as it:
+                        for dir_entry in it:
+                            if dir_entry.is_dir(follow_symlinks=False):
+                                names.append(dir_entry.name)
+                                stack.append(dir_entry.path)
+                            elif dir_entry.is_file():
+                                names.append(dir_entry.name)
+                                st = dir_entry.stat()
+                                if self._file_changed(dir_entry.path, st):
+                                    changed.append((dir_entry.path, st.st_mtime))
+                except OSError as e:
+                    logger.error("Error scanning %s: %s", directory, e)
+                    continue
+
+                if isinstance(entry, DirEntry):
+                    for name in set(entry.names).difference(names):
+                        if self._forget(os.path.join(directory, name)):
+                            deleted.append(os.path.join(directory, name))
+                self._put(directory, DirEntry(dir_st.st_mtime_ns, tuple(names)))
+        logger.debug("Index scan of %s found %d changed files and %d deleted paths", roots, len(changed),
+                     len(deleted))
+        return changed, deleted
@@ -1,24 +1,60 @@
-from persistence import PersistentSet, FileData
+from paths import moved_path
+from persistence import PersistentDict, FileData
 
 
-class FilesPersistentSet(PersistentSet):
-    """Class to manage a persistent set of file data."""
+class FilesPersistentSet(PersistentDict):
+    """Class to manage a persistent queue of file data keyed by file name.
+
+    Only the latest modification time of each file is kept, so repeated changes to a file
+    before it is synced collapse into a single entry.
+    """
 
     def __init__(self, pkl_filename):
         super().__init__(pkl_filename)
 
+    def _apply(self, op, element):
+        """Apply a journal operation; FileData objects are journaled whole and removed by file name."""
+        if op == 'add':
+            current = self.set.get(element.name)
+            if current is None or element.time >= current.time:
+                self.set[element.name] = element
+        else:
+            super()._apply(op, element)
+
+    def _snapshot(self):
+        """Return the queued FileData objects."""
+        return list(self.set.values())
+
     def add(self, file_name, modified_time):
-        """Add a file with its modification time to the set."""
+        """Queue a file, replacing any older entry for the same name."""
         super().add(FileData(file_name, modified_time))
 
-    def remove(self, file_name):
-        """Remove a file from the set."""
-        self.set = {filedata for filedata in self.set if filedata.name != file_name}
-        self._save_set()
+    def remove(self, file_name, modified_time=None):
+        """Remove a file from the queue.
+
+        With 'modified_time', the entry is kept if the file was modified again after that time.
+        """
+        with self.lock:
+            current = self.set.get(file_name)
+            if current is None or (modified_time is not None and current.time > modified_time):
+                return
+            self._delete(file_name)
+
+    def move(self, src, dest=None):
+        """Re-queue entries at or under 'src' under 'dest', or drop them if 'dest' is None."""
+        with self.batch():
+            for filedata in [filedata for filedata in self.set.values() if moved_path(filedata.name, src, src)]:
+                self._delete(filedata.name)
+                if dest is not None:
+                    element = FileData(moved_path(filedata.name, src, dest), filedata.time)
+                    self._apply('add', element)
+                    self._log('add', element)
 
     def get(self, file_name):
         """Retrieve a FileData object based on the file name."""
-        for filedata in self.set:
-            if filedata.name == file_name:
-                return filedata
-        return None
+        return self.set.get(file_name)
+
+    def list(self):
+        """Return a list of the queued FileData objects."""
+        with self.lock:
+            return list(self.set.values())
@@ -1,45 +1,129 @@
 import logging
 
 from pyinotify import ProcessEvent
-import time
 import os
+from debouncer import Debouncer
+from paths import TEMP_PREFIX
 
 logger = logging.getLogger('tsync')
 logger.setLevel(logging.DEBUG)
 
+# Seconds a file must go without IN_MODIFY events before it is queued
+SETTLE_TIME = 5
+# Shorter settle after IN_CLOSE_WRITE, which usually means the writer is done
+CLOSE_WRITE_SETTLE_TIME = 0.5
+# Seconds to wait for the IN_MOVED_TO matching an IN_MOVED_FROM before treating the move as a delete
+MOVE_PAIR_TIME = 1
+
 
 class Filewatcher(ProcessEvent):
-    """Find which files to sync."""
+    """Find which files to sync, and which paths were renamed or deleted.
+
+    Renames and deletes are queued on 'ops'; paths in 'pulled_files' were changed by the server
+    and are not reported back.
+    """
 
-    def __init__(self, mfiles, rfiles, pulled_files):
+    def __init__(self, mfiles, ops, pulled_files, settle_time=SETTLE_TIME,
+                 close_write_settle_time=CLOSE_WRITE_SETTLE_TIME, move_pair_time=MOVE_PAIR_TIME):
         self.mfiles = mfiles
-        self.rfiles = rfiles
+        self.ops = ops
         self.pulled_files = pulled_files
+        self.close_write_settle_time = close_write_settle_time
+        self.debouncer = Debouncer(self.release, settle_time)
+        self.debouncer.start()
+        self.moves = {}  # cookie -> path of an IN_MOVED_FROM still waiting for its IN_MOVED_TO
+        self.move_timer = Debouncer(self.moved_away, move_pair_time)
+        self.move_timer.start()
+
+    def release(self, filename):
+        """Queue a file that has stopped changing, unless it was written by a pull."""
+        if filename in self.pulled_files:
+            self.pulled_files.discard(filename)
+            return
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            return  # Removed or renamed before it settled
+        self.mfiles.add(filename, mtime)
+        logger.info("Queued file: %s", filename)
 
     def process_IN_CREATE(self, event):
+        if event.dir:
+            return  # Watched through auto_add; its files raise their own events
         filename = os.path.join(event.path, event.name)
-        if filename not in self.pulled_files:
-            # Add a delay before adding the file to the mfiles set
-            time.sleep(5)
-            self.mfiles.add(filename, time.time())
-            logger.info("Created file: %s", filename)
-        else:
-            self.pulled_files.remove(filename)
+        if event.name.startswith(TEMP_PREFIX):
+            return
+        self.debouncer.touch(filename)
+        logger.info("Created file: %s", filename)
+
+    def deleted(self, path):
+        """Forget a deleted file or directory and queue its deletion."""
+        self.debouncer.move(path)
+        self.mfiles.move(path)
+        if path in self.pulled_files:
+            self.pulled_files.discard(path)
+            return
+        self.ops.append('delete', path)
+        logger.info("Removed: %s", path)
+
+    def renamed(self, src, dest):
+        """Carry pending changes over to the new name and queue the rename."""
+        if os.path.basename(src).startswith(TEMP_PREFIX):
+            # A file written by tsync was moved into place
+            self.debouncer.move(src)
+            self.pulled_files.discard(dest)
+            return
+        self.debouncer.move(src, dest)
+        self.mfiles.move(src, dest)
+        if src in self.pulled_files:
+            self.pulled_files.discard(src)
+            return
+        self.ops.append('rename', src, dest)
+        logger.info("Renamed %s to %s", src, dest)
+
+    def moved_away(self, cookie):
+        """An IN_MOVED_FROM got no matching IN_MOVED_TO: the path left the watched tree."""
+        path = self.moves.pop(cookie, None)
+        if path is not None:
+            self.deleted(path)
+
+    def moved_in(self, path, is_dir):
+        """A path was moved in from outside the watched tree; its files are new."""
+        if not is_dir:
+            self.debouncer.touch(path)
+            return
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                self.debouncer.touch(os.path.join(root, filename))
 
     def process_IN_DELETE(self, event):
-        filename = os.path.join(event.path, event.name)
-        self.rfiles.add(filename)
-        try:
-            self.mfiles.remove(filename)
-        except KeyError:
-            pass
-        logger.info("Removed file: %s", filename)
+        if event.name.startswith(TEMP_PREFIX):
+            return
+        self.deleted(os.path.join(event.path, event.name))
+
+    def process_IN_MOVED_FROM(self, event):
+        self.moves[event.cookie] = os.path.join(event.path, event.name)
+        self.move_timer.touch(event.cookie)
+
+    def process_IN_MOVED_TO(self, event):
+        dest = os.path.join(event.path, event.name)
+        src = self.moves.pop(event.cookie, None)
+        if src is None:
+            self.moved_in(dest, event.dir)
+        else:
+            self.move_timer.cancel(event.cookie)
+            self.renamed(src, dest)
 
     def process_IN_MODIFY(self, event):
         filename = os.path.join(event.path, event.name)
-        if filename not in self.pulled_files:
-            time.sleep(5)
-            self.mfiles.add(filename, time.time())
-            logger.info("Modified file: %s", filename)
-        else:
-            self.pulled_files.remove(filename)
+        if event.name.startswith(TEMP_PREFIX):
+            return
+        self.debouncer.touch(filename)
+        logger.debug("Modified file: %s", filename)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        filename = os.path.join(event.path, event.name)
+        if event.name.startswith(TEMP_PREFIX):
+            return
+        self.debouncer.touch(filename, self.close_write_settle_time)
+        logger.debug("Closed file after writing: %s", filename)
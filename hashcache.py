@@ -0,0 +1,41 @@
+import os
+
+import delta
+from persistence import PersistentDict
+
+
+class HashCache(PersistentDict):
+    """Persistent cache of file content digests keyed by (device, inode, size, mtime_ns).
+
+    Only the latest (size, mtime_ns, digest) is kept per inode, so the cache stays as large as
+    the set of files it has seen rather than the number of versions.
+    """
+
+    def __init__(self, pkl_filename):
+        super().__init__(pkl_filename)
+
+    def digest(self, path):
+        """Return the content digest of 'path', hashing it only if it changed since last time.
+
+        Raises OSError if the file cannot be read.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        with self.lock:
+            cached = self.set.get(key)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+        digest = delta.file_digest(path)
+        after = os.stat(path)
+        # Do not cache a digest of a file that was being written while we hashed it
+        if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            with self.lock:
+                self._put(key, (st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def matches(self, path, digest):
+        """Return True if 'path' exists and its content has the given digest."""
+        try:
+            return self.digest(path) == digest
+        except OSError:
+            return False
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Seconds between probes of a healthy peer
+PROBE_INTERVAL = 30
+# Probes running at once
+PROBE_WORKERS = 8
+# Consecutive failures, from probes or transfers, that open a peer's circuit
+FAILURE_THRESHOLD = 2
+# A peer whose circuit is open is probed again after BACKOFF_MIN seconds, doubling up to BACKOFF_MAX
+BACKOFF_MIN = 2
+BACKOFF_MAX = 300
+
+
+class _Peer:
+    """Circuit state of one peer."""
+
+    __slots__ = ('failures', 'open', 'next_probe', 'probing')
+
+    def __init__(self):
+        self.failures = 0
+        self.open = True  # Unknown until the first probe answers
+        self.next_probe = 0
+        self.probing = False
+
+
+class HealthMonitor:
+    """Probe peers concurrently in the background, keeping a circuit breaker per peer.
+
+    'probe(peer)' must return True if the peer answered, within its own timeout. A peer's
+    circuit opens after FAILURE_THRESHOLD failures in a row and closes on the next success;
+    'on_change(peer, healthy)' is called each time it flips. Healthy peers are probed every
+    'interval' seconds, peers with an open circuit with exponential backoff, so a dead peer
+    costs a probe now and then instead of stalling its callers.
+    """
+
+    def __init__(self, peers, probe, on_change, interval=PROBE_INTERVAL, workers=PROBE_WORKERS,
+                 threshold=FAILURE_THRESHOLD, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self.probe = probe
+        self.on_change = on_change
+        self.interval = interval
+        self.threshold = threshold
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.peers = {peer: _Peer() for peer in peers}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tsync-probe')
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start probing."""
+        self.thread.start()
+
+    def healthy(self, peer):
+        """Return True if the circuit of 'peer' is closed."""
+        with self.cond:
+            return not self.peers[peer].open
+
+    def check_now(self, peer=None):
+        """Probe one peer, or all of them, as soon as possible."""
+        with self.cond:
+            for name, state in self.peers.items():
+                if peer is None or name == peer:
+                    state.next_probe = 0
+            self.cond.notify()
+
+    def record(self, peer, ok):
+        """Count a success or failure of 'peer', from a probe or from any call to it."""
+        with self.cond:
+            state = self.peers[peer]
+            changed = False
+            if ok:
+                state.failures = 0
+                changed, state.open = state.open, False
+                state.next_probe = time.monotonic() + self.interval
+            else:
+                state.failures += 1
+                if state.open:
+                    delay = min(self.backoff_max, self.backoff_min * 2 ** (state.failures - 1))
+                    state.next_probe = time.monotonic() + delay
+                elif state.failures >= self.threshold:
+                    state.open = changed = True
+                    state.next_probe = time.monotonic() + self.backoff_min
+                else:
+                    state.next_probe = 0  # Confirm with a probe right away
+            self.cond.notify()
+        if changed:
+            logger.info("Peer %s is %s", peer, "unhealthy" if not ok else "healthy again")
+            self.on_change(peer, ok)
+
+    def _probe(self, peer):
+        try:
+            ok = bool(self.probe(peer))
+        except Exception as e:
+            logger.debug("Probe of %s failed: %s", peer, e)
+            ok = False
+        with self.cond:
+            self.peers[peer].probing = False
+        self.record(peer, ok)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                due = [peer for peer, state in self.peers.items() if not state.probing and state.next_probe <= now]
+                for peer in due:
+                    self.peers[peer].probing = True
+                if not due:
+                    waits = [state.next_probe - now for state in self.peers.values() if not state.probing]
+                    self.cond.wait(min(waits) if waits else None)
+                    continue
+            try:
+                for peer in due:
+                    self.executor.submit(self._probe, peer)
+            except RuntimeError:
+                return  # The interpreter is shutting down
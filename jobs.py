@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Finished jobs are reported to the peer that started them in batches gathered over this window
+REPORT_WINDOW = 0.2
+# Outcomes of this many jobs are kept for status queries
+JOB_HISTORY = 4096
+# Seconds after which a job the peer has not reported is polled for
+POLL_AFTER = 30
+
+
+def succeeded(future):
+    """Return True if a finished job returned a true result."""
+    return future.exception() is None and bool(future.result())
+
+
+class JobTable:
+    """Jobs run in the background on behalf of a peer, by id.
+
+    Outcomes are passed to 'report' as [job id, ok] pairs, batched over a short window, from a
+    thread of their own. If the peer cannot be told it asks later through status().
+    """
+
+    def __init__(self, report, window=REPORT_WINDOW, history=JOB_HISTORY):
+        self.report = report
+        self.window = window
+        self.history = history
+        self.jobs = OrderedDict()  # job id -> Future, oldest first
+        self.finished = []  # [job id, ok] not reported yet
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the reporting thread."""
+        self.thread.start()
+
+    def add(self, future):
+        """Track the job behind 'future' and return its id."""
+        job_id = uuid.uuid4().hex
+        with self.cond:
+            self.jobs[job_id] = future
+            while len(self.jobs) > self.history and next(iter(self.jobs.values())).done():
+                self.jobs.popitem(last=False)
+        future.add_done_callback(partial(self._finished, job_id))
+        return job_id
+
+    def _finished(self, job_id, future):
+        with self.cond:
+            self.finished.append([job_id, succeeded(future)])
+            self.cond.notify()
+
+    def status(self, job_ids):
+        """Return 'running', 'done', 'failed' or 'unknown' for each job id."""
+        with self.cond:
+            futures = [self.jobs.get(job_id) for job_id in job_ids]
+        return ['unknown' if future is None else 'running' if not future.done() else
+                'done' if succeeded(future) else 'failed' for future in futures]
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.finished:
+                    self.cond.wait()
+            time.sleep(self.window)
+            with self.cond:
+                batch, self.finished = self.finished, []
+            try:
+                if not self.report(batch):
+                    logger.debug("Could not report %d finished jobs; they will be polled for", len(batch))
+            except Exception as e:
+                logger.error("Error reporting finished jobs: %s", e)
+
+
+class RemoteJobs:
+    """Jobs started on peers, each with a Future resolved to True or False once its outcome is known."""
+
+    def __init__(self):
+        self.jobs = {}  # (peer, job id) -> (Future, start time)
+        self.early = {}  # (peer, job id) -> (ok, time) of outcomes reported before the job was expected
+        self.lock = threading.Lock()
+
+    def expect(self, peer, job_id):
+        """Return a Future for the outcome of a job just started on 'peer'."""
+        future = Future()
+        with self.lock:
+            early = self.early.pop((peer, job_id), None)
+            if early is None:
+                self.jobs[(peer, job_id)] = (future, time.monotonic())
+        if early is not None:
+            future.set_result(early[0])
+        return future
+
+    def finish(self, peer, job_id, ok):
+        """Resolve a job with its outcome."""
+        with self.lock:
+            entry = self.jobs.pop((peer, job_id), None)
+            if entry is None:
+                # The report can overtake the reply that started the job
+                self.early[(peer, job_id)] = (ok, time.monotonic())
+                return
+        entry[0].set_result(ok)
+
+    def fail(self, peer):
+        """Resolve every job of 'peer' as failed."""
+        with self.lock:
+            keys = [key for key in self.jobs if key[0] == peer]
+            futures = [self.jobs.pop(key)[0] for key in keys]
+        for future in futures:
+            future.set_result(False)
+
+    def overdue(self, age=POLL_AFTER):
+        """Return {peer: [job id]} of the jobs started more than 'age' seconds ago."""
+        now = time.monotonic()
+        overdue = {}
+        with self.lock:
+            for key in [key for key, (_, reported) in self.early.items() if now - reported > age]:
+                del self.early[key]
+            for (peer, job_id), (_, started) in self.jobs.items():
+                if now - started > age:
+                    overdue.setdefault(peer, []).append(job_id)
+        return overdue
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs)
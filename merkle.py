@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import os
+from collections import namedtuple
+
+from paths import TEMP_PREFIX
+from persistence import PersistentDict
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+Node = namedtuple('Node', ['hash', 'children'])  # children: name -> (kind, hash), kind 'f' or 'd'
+
+
+def node_hash(children):
+    """Return the hash of a directory from the kinds, names and hashes of its children."""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(children):
+        kind, child_hash = children[name]
+        digest.update(f"{kind} {name} {child_hash}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def compare_child(mine, theirs, synced):
+    """Decide what reconcile does with a child whose (kind, hash) differs between the two trees.
+
+    'mine' and 'theirs' are None where the child is missing, and 'synced' tells whether the local
+    file still has the content it was last synced with. Returns 'descend' for a directory on both
+    sides, 'push' for local content that changed here or the server never had, 'fetch' for content
+    only the server has or that changed only there, and None for a file the server deleted.
+    """
+    if mine is not None and theirs is not None and mine[0] == theirs[0] == 'd':
+        return 'descend'
+    if mine is not None and theirs is None and synced:
+        return None
+    if mine is not None and not (theirs is not None and theirs[0] == 'f' and synced):
+        return 'push'
+    return 'fetch'
+
+
+class MerkleTree(PersistentDict):
+    """Persistent Merkle tree of the watch dirs: one node per directory, keyed by its path under 'base'.
+
+    A directory's hash covers the names and hashes of its children, files being hashed by content,
+    so two trees are equal below a directory exactly when its hashes match. Paths are relative to
+    'base' (the home directory on a client, ~/.tsync on the server) so both ends name them alike.
+    """
+
+    def __init__(self, pkl_filename, base, roots, hashes):
+        self.base = base
+        self.roots = [os.path.relpath(root, base) for root in roots]
+        self.hashes = hashes
+        self.dirty = set()
+        super().__init__(pkl_filename)
+
+    def _put(self, rel, node):
+        """Record a node, journaling it only if it changed."""
+        if self.set.get(rel) != node:
+            super()._put(rel, node)
+
+    def _prune(self):
+        """Remove the nodes of directories no longer reachable from the base."""
+        reachable = set()
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            node = self.set.get(rel)
+            if node is None:
+                continue
+            reachable.add(rel)
+            stack.extend(os.path.join(rel, name) if rel else name
+                         for name, (kind, _) in node.children.items() if kind == 'd')
+        for rel in [rel for rel in self.set if rel not in reachable]:
+            self._delete(rel)
+
+    def _rel(self, path):
+        rel = os.path.relpath(path, self.base)
+        return '' if rel == '.' else rel
+
+    def _watched(self, rel):
+        return any(rel == root or rel.startswith(root + os.sep) for root in self.roots)
+
+    def node(self, rel):
+        """Return the Node of a directory, or None."""
+        with self.lock:
+            return self.set.get(rel)
+
+    def touch(self, path):
+        """Note that 'path' changed; its directories are rehashed on the next refresh of dirty paths."""
+        with self.lock:
+            self.dirty.add(path)
+
+    def take_dirty(self):
+        """Return and clear the paths changed since the last call."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return dirty
+
+    def _scan(self, rel, reuse=False):
+        """Hash directory 'rel' from disk and return its hash.
+
+        Subdirectories are scanned too, unless 'reuse' is set and they already have a node.
+        """
+        children = {}
+        try:
+            with os.scandir(os.path.join(self.base, rel)) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.debug("Cannot list %s: %s", rel, e)
+            entries = []
+        for entry in entries:
+            if entry.name.startswith(TEMP_PREFIX):
+                continue
+            child = os.path.join(rel, entry.name) if rel else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                existing = self.set.get(child) if reuse else None
+                children[entry.name] = ('d', existing.hash if existing is not None else self._scan(child, reuse))
+            elif entry.is_file(follow_symlinks=False):
+                try:
+                    children[entry.name] = ('f', self.hashes.digest(entry.path))
+                except OSError:
+                    continue
+        node = Node(node_hash(children), children)
+        self._put(rel, node)
+        return node.hash
+
+    def _propagate(self, rel, child_hash):
+        """Set the hash of directory 'rel' (None if gone) in its parents, up to the base."""
+        while rel:
+            parent = os.path.dirname(rel)
+            node = self.set.get(parent)
+            children = dict(node.children) if node is not None else {}
+            if child_hash is None:
+                children.pop(os.path.basename(rel), None)
+            else:
+                children[os.path.basename(rel)] = ('d', child_hash)
+            if not children and not self._watched(parent):
+                # An ancestor of the roots with nothing watched below
+                if parent in self.set:
+                    self._delete(parent)
+                child_hash = None
+            else:
+                node = Node(node_hash(children), children)
+                self._put(parent, node)
+                child_hash = node.hash
+            rel = parent
+
+    def refresh(self, paths=None):
+        """Rehash the whole tree, or only the directories holding the given changed paths."""
+        with self.batch():
+            if paths is None:
+                for root in self.roots:
+                    self._propagate(root, self._scan(root) if os.path.isdir(os.path.join(self.base, root)) else None)
+            else:
+                dirs = {self._rel(os.path.dirname(path)) for path in paths}
+                # Deepest first, so each directory sees the new hashes of the changed ones below it
+                for rel in sorted(dirs, key=lambda rel: rel.count(os.sep), reverse=True):
+                    if not self._watched(rel):
+                        continue
+                    exists = os.path.isdir(os.path.join(self.base, rel))
+                    self._propagate(rel, self._scan(rel, reuse=True) if exists else None)
+            self._prune()
+
+    def nodes(self, rels):
+        """Return [path, hash, children] for each of the given directories that exists."""
+        with self.lock:
+            return [[rel, node.hash, {name: list(child) for name, child in node.children.items()}]
+                    for rel, node in ((rel, self.set.get(rel)) for rel in rels) if node is not None]
@@ -2,6 +2,7 @@ import argparse
 import logging
 import configparser
 import os
+import transfer
 from base import Base
 from server import Server, ClientData
 from client import Client
@@ -61,6 +62,8 @@ def main():
     parser.add_argument('-port', help='Specify the port of this machine to run RPC server', required=True)
     parser.add_argument('-uname', help='Specify the user name of this machine', required=True)
     parser.add_argument('-role', help='Specify the role of this machine - client or server', required=True)
+    parser.add_argument('-transport', help='File transfer method; local copies on this machine for loopback testing',
+                        choices=sorted(transfer.TRANSPORTS), default='scp')
 
     args = parser.parse_args()
 
@@ -68,6 +71,7 @@ def main():
     setup_logging(log_filename)
 
     config = load_config()
+    transfer.pool.transport_class = transfer.TRANSPORTS[args.transport]
 
     if args.role == 'server':
         processes = Server(args.role, args.ip, int(args.port), args.uname, get_watch_dirs(config, args.uname, args.role),
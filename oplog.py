@@ -0,0 +1,26 @@
+from persistence import PersistentDict
+
+
+class OpLog(PersistentDict):
+    """Persistent, ordered queue of namespace operations waiting to be sent to a peer.
+
+    Operations are tuples: ('rename', src, dest) or ('delete', path). Each is stored under an
+    increasing sequence number and is removed by that number once the peer has applied it.
+    """
+
+    def __init__(self, pkl_filename, wakeup=None):
+        super().__init__(pkl_filename, wakeup=wakeup)
+        self.next_seq = max(self.set, default=0) + 1
+
+    def append(self, *operation):
+        """Queue an operation after all the others."""
+        with self.lock:
+            self._put(self.next_seq, operation)
+            self.next_seq += 1
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def list(self):
+        """Return the queued (seq, operation) pairs in order."""
+        with self.lock:
+            return list(self.set.items())
@@ -0,0 +1,14 @@
+import os
+
+# Files tsync writes next to their target before renaming them into place start with this, so the
+# watcher and tree scans can tell them from the user's own
+TEMP_PREFIX = '.tsync-'
+
+
+def moved_path(path, src, dest):
+    """Return where 'path' ends up when 'src' is renamed to 'dest', or None if it is not under 'src'."""
+    if path == src:
+        return dest
+    if path.startswith(src.rstrip(os.sep) + os.sep):
+        return dest + path[len(src.rstrip(os.sep)):]
+    return None
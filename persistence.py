@@ -1,66 +1,226 @@
 import os
 import pickle
+import threading
 import time
+from contextlib import contextmanager
+
+# Rewrite the snapshot once the journal holds more records than this (or than the set itself)
+COMPACT_THRESHOLD = 1024
 
 
 class FileData:
     """Class to hold file name and modification time."""
 
+    __slots__ = ('name', 'time')
+
     def __init__(self, file_name, mod_time):
         self.name = file_name
         self.time = mod_time
 
+    def __eq__(self, other):
+        if not isinstance(other, FileData):
+            return NotImplemented
+        return (self.name, self.time) == (other.name, other.time)
+
+    def __hash__(self):
+        return hash((self.name, self.time))
+
+    def __getstate__(self):
+        return {'name': self.name, 'time': self.time}
+
+    def __setstate__(self, state):
+        # Pickles written before __slots__ carry the same keys in their __dict__
+        self.name = state['name']
+        self.time = state['time']
+
+    def to_dict(self):
+        """Return the fields as a dict, the form XML-RPC can marshal."""
+        return {'name': self.name, 'time': self.time}
+
 
 class PersistentSet:
-    """Class to manage a persistent set of items using pickle."""
+    """Class to manage a persistent set of items using a pickle snapshot and an append-only journal.
 
-    def __init__(self, pkl_filename):
+    Every change is appended to '<pkl_filename>.journal' instead of re-pickling the whole set; the
+    snapshot is rewritten only when the journal has grown past the size of the set.
+    """
+
+    def __init__(self, pkl_filename, compact_threshold=COMPACT_THRESHOLD, wakeup=None):
         self.pkl_filename = pkl_filename
+        # Event set whenever an element is added, so a consumer can sleep until there is work
+        self.wakeup = wakeup
+        self.journal_filename = f"{pkl_filename}.journal"
+        self.compact_threshold = compact_threshold
         self.timestamp = None
+        self.lock = threading.RLock()
+        self._batch_depth = 0
+        self._journal_records = 0
         self.set = self._load_set()
+        self._journal = open(self.journal_filename, 'ab')
+        if self._journal_records:
+            self._compact()
+
+    def _new_set(self):
+        """Return the empty in-memory container."""
+        return set()
+
+    def _apply(self, op, element):
+        """Apply a single journal operation to the in-memory set."""
+        if op == 'add':
+            self.set.add(element)
+        elif op == 'remove':
+            self.set.discard(element)
+        elif op == 'timestamp':
+            self.timestamp = element
 
     def _load_set(self):
-        """Load the set from a pickle file."""
+        """Load the snapshot and replay the journal on top of it."""
+        self.set = self._new_set()
         if os.path.exists(self.pkl_filename):
             try:
                 with open(self.pkl_filename, 'rb') as pkl_file:
-                    return pickle.load(pkl_file)
+                    for element in pickle.load(pkl_file):
+                        self._apply('add', element)
+                    self.timestamp = pickle.load(pkl_file)
             except (EOFError, pickle.UnpicklingError):
-                pass  # Handle empty or corrupt pickle file
-        return set()
+                pass  # Handle empty or corrupt pickle file, or a snapshot without timestamp
+        self._replay_journal()
+        return self.set
+
+    def _replay_journal(self):
+        """Replay journal records, cutting off a record left half-written by a crash."""
+        if not os.path.exists(self.journal_filename):
+            return
+        with open(self.journal_filename, 'r+b') as journal:
+            good_offset = 0
+            while True:
+                try:
+                    op, element = pickle.load(journal)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                self._apply(op, element)
+                self._journal_records += 1
+                good_offset = journal.tell()
+            journal.truncate(good_offset)
 
     def _save_set(self):
         """Save the set to a pickle file."""
-        with open(self.pkl_filename, 'wb') as pkl_file:
-            pickle.dump(self.set, pkl_file)
+        tmp_filename = f"{self.pkl_filename}.tmp"
+        with open(tmp_filename, 'wb') as pkl_file:
+            pickle.dump(self._snapshot(), pkl_file)
+            if self.timestamp is not None:
+                pickle.dump(self.timestamp, pkl_file)
+            pkl_file.flush()
+            os.fsync(pkl_file.fileno())
+        os.replace(tmp_filename, self.pkl_filename)
+
+    def _snapshot(self):
+        """Return the picklable contents of the set."""
+        return self.set
+
+    def _compact(self):
+        """Fold the journal into a fresh snapshot and start an empty journal."""
+        # Replaying an old journal over a newer snapshot is harmless, so a crash between these
+        # two steps loses nothing.
+        self._save_set()
+        self._journal.truncate(0)
+        self._journal_records = 0
+
+    def _log(self, op, element):
+        """Append an operation to the journal."""
+        pickle.dump((op, element), self._journal)
+        self._journal_records += 1
+        if not self._batch_depth:
+            self._commit()
+
+    def _commit(self):
+        """Make journaled operations durable and compact if the journal got too long."""
+        self._journal.flush()
+        if self._journal_records > max(self.compact_threshold, len(self.set)):
+            self._compact()
+
+    @contextmanager
+    def batch(self):
+        """Group several changes into a single journal commit."""
+        with self.lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._commit()
 
     def add(self, element):
         """Add an element to the set and save."""
-        self.set.add(element)
-        self._save_set()
+        with self.lock:
+            self._apply('add', element)
+            self._log('add', element)
+        if self.wakeup is not None:
+            self.wakeup.set()
 
     def remove(self, element):
         """Remove an element from the set and save."""
-        self.set.remove(element)
-        self._save_set()
+        with self.lock:
+            self.set.remove(element)
+            self._log('remove', element)
+
+    def __len__(self):
+        return len(self.set)
 
     def list(self):
         """Return a list of elements in the set."""
-        return list(self.set)
+        with self.lock:
+            return list(self.set)
 
     def get_modified_timestamp(self):
-        """Get the modified timestamp from the pickle file."""
-        if os.path.exists(self.pkl_filename):
-            try:
-                with open(self.pkl_filename, 'rb') as pkl_file:
-                    pickle.load(pkl_file)  # Load set
-                    return pickle.load(pkl_file)  # Load timestamp
-            except (EOFError, pickle.UnpicklingError):
-                pass  # Handle empty or corrupt pickle file
-        return 0  # File does not exist or is empty
+        """Get the modified timestamp recorded by update_modified_timestamp."""
+        return self.timestamp or 0
 
     def update_modified_timestamp(self):
-        """Update the modified timestamp in the pickle file."""
-        with open(self.pkl_filename, 'wb') as pkl_file:
-            pickle.dump(self.set, pkl_file)
-            pickle.dump(time.time(), pkl_file)
+        """Record the current time as the modified timestamp."""
+        with self.lock:
+            self.timestamp = time.time()
+            self._log('timestamp', self.timestamp)
+
+
+class PersistentDict(PersistentSet):
+    """PersistentSet holding a key -> value mapping.
+
+    Entries are journaled and snapshotted as (key, value) pairs and removed by key. Subclasses
+    change them through _put and _delete while holding the lock.
+    """
+
+    def _new_set(self):
+        """Return the empty mapping."""
+        return {}
+
+    def _apply(self, op, element):
+        """Apply a journal operation; entries are journaled as (key, value) pairs."""
+        if op == 'add':
+            key, value = element
+            self.set[key] = value
+        elif op == 'remove':
+            self.set.pop(element, None)
+        else:
+            super()._apply(op, element)
+
+    def _snapshot(self):
+        """Return the (key, value) pairs of the mapping."""
+        return list(self.set.items())
+
+    def _put(self, key, value):
+        """Set an entry and journal it."""
+        self._apply('add', (key, value))
+        self._log('add', (key, value))
+
+    def _delete(self, key):
+        """Drop an entry and journal it."""
+        self._apply('remove', key)
+        self._log('remove', key)
+
+    def remove(self, key):
+        """Remove the entry for 'key', if any, and save."""
+        with self.lock:
+            if key in self.set:
+                self._delete(key)
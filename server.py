@@ -1,17 +1,35 @@
 import logging
 import re
+import threading
 import time
 import errno
-from base import Base
+from functools import partial
+from base import Base, UP_TO_DATE, INLINE_MAX_SIZE
 import os
+import xmlrpc.client
+import zlib
+import chunked
+import compression
+import sparse
 import sxmlr
-from persistence import PersistentSet
+from changelog import ChangeLog
+from chunkstore import ChunkStore
+from hashcache import HashCache
+from health import HealthMonitor
+from jobs import RemoteJobs
+from merkle import MerkleTree
+from workers import TransferWorkers
 
 from plyer import notification
 
 logger = logging.getLogger('tsync')
 logger.setLevel(logging.DEBUG)
 
+# After being woken, wait this long so a burst of acknowledged pushes goes out together
+SYNC_BATCH_WINDOW = 0.2
+# Seconds between retries while files are pending for some client
+SYNC_RETRY_INTERVAL = 10
+
 
 def is_collision_file(filename):
     """Check if the given filename is a collision backup file."""
@@ -24,10 +42,14 @@ class ClientData:
 
     def __init__(self, client_uname, client_ip, client_port):
         self.available = False
-        self.mfiles = PersistentSet(f'server-{client_uname}.pkl')
+        # Files of the current catch-up still being transferred, and whether any of them failed
+        self.pending = 0
+        self.failed = False
         self.uname = client_uname
         self.ip = client_ip
         self.port = client_port
+        # Several clients may share a user name; the address tells them apart
+        self.id = f"{client_ip}:{client_port}"
 
 
 class Server(Base):
@@ -39,6 +61,18 @@ class Server(Base):
             'ack_push_file': self.ack_push_file,
             'mark_presence': self.mark_presence,
             'req_push_file': self.req_push_file,
+            'req_push_files': self.req_push_files,
+            'ack_push_files': self.ack_push_files,
+            'push_files_inline': self.push_files_inline,
+            'missing_chunks': self.missing_chunks,
+            'put_chunks': self.put_chunks,
+            'assemble_file': self.assemble_file,
+            'rename_path': self.rename_path,
+            'tree_nodes': self.tree_nodes,
+            'resend_paths': self.resend_paths,
+            'caught_up': self.caught_up,
+            'jobs_done': self.jobs_done,
+            'delete_path': self.delete_path,
             'sync_files': self.sync_files,
             'add_client_keys': self.add_client_keys,
             'collision_check': self.collision_check,
@@ -49,14 +83,32 @@ class Server(Base):
             'get_public_key': self.get_public_key,
 
         }
+        self.server.funcs.update(self.funcs)
         self.clients = clients
+        self.work_ready = threading.Event()
+        self.changelog = ChangeLog('server-changelog.pkl', wakeup=self.work_ready)
+        self.hashes = HashCache('server-hashes.pkl')
+        self.chunks = ChunkStore('server-chunks.pkl', blob_dir=os.path.join("/home", uname, ".tsync", ".chunks"))
+        self.transfers = TransferWorkers()
+        self.pulls = RemoteJobs()
+        self.health = HealthMonitor([client.id for client in clients], self.probe_client, self._client_health)
+        self.tree = MerkleTree('server-tree.pkl', base=os.path.join("/home", uname, ".tsync"), roots=watch_dirs,
+                               hashes=self.hashes)
+        self.tree_loaded = False
 
     def req_push_file(self, filedata, source_uname, source_ip, source_port):
         """Handle file push request from a client."""
         logger.debug("server filedata %s %s", filedata['name'], list(filedata.keys()))
 
         # Add self.role as an argument to the get_dest_path method
-        my_file = Base.get_dest_path(filedata['name'], self.username, self.role)
+        my_file = self.safe_path(Base.get_dest_path(filedata['name'], self.username, self.role))
+        if my_file is None:
+            return False
+
+        digest = filedata.get('digest')
+        if digest is not None and self.hashes.matches(my_file, digest):
+            logger.debug("Server already has the content of %s, skipping transfer", filedata['name'])
+            return UP_TO_DATE
 
         if self.collision_check(filedata):
             server_filename = f"{my_file}.backup.{filedata['time']}.{source_uname}.{source_ip}:{source_port}"
@@ -68,6 +120,9 @@ class Server(Base):
 
     def ack_push_file(self, server_filename, source_uname, source_ip, source_port):
         """Acknowledge the successful push of a file."""
+        server_filename = self.safe_path(server_filename)
+        if server_filename is None:
+            return False
         if is_collision_file(server_filename):
             notification_title = "Collision Detected"
             notification_text = f"Collision detected for file {server_filename}."
@@ -77,11 +132,175 @@ class Server(Base):
                 app_name='TSYnc'
             )
 
-        for client in self.clients:
-            if (client.ip, client.port) == (source_ip, source_port):
-                continue
-            client.mfiles.add(server_filename)  # the file is in the server's directory ./.tsync
-            logger.debug("File added to modified list for client %s", client.uname)
+        # the file is in the server's directory ./.tsync
+        self.changelog.append('write', server_filename, origin=self.origin(source_uname, source_ip, source_port))
+        self.tree.touch(server_filename)
+        self.chunks.index_later(server_filename)
+
+    def req_push_files(self, manifest, source_uname, source_ip, source_port):
+        """Handle a batch of push requests; return the server path, or UP_TO_DATE, for each file."""
+        logger.debug("Push request for %d files from %s", len(manifest), source_uname)
+        return [self.req_push_file(filedata, source_uname, source_ip, source_port) for filedata in manifest]
+
+    def ack_push_files(self, server_filenames, source_uname, source_ip, source_port):
+        """Acknowledge a batch of pushed files, committing the changelog once."""
+        with self.changelog.batch():
+            for server_filename in server_filenames:
+                self.ack_push_file(server_filename, source_uname, source_ip, source_port)
+        return True
+
+    def push_files_inline(self, entries, source_uname, source_ip, source_port):
+        """Write and acknowledge small files whose contents came inside the call.
+
+        'entries' holds [filedata, contents, compressed] triples. Returns, for each, the server path,
+        UP_TO_DATE, or False if it could not be written.
+        """
+        results = []
+        written = []
+        for filedata, payload, compressed in entries:
+            server_filename = self.req_push_file(filedata, source_uname, source_ip, source_port)
+            if server_filename != UP_TO_DATE:
+                if not self.write_file_inline(server_filename, payload, compressed):
+                    results.append(False)
+                    continue
+                written.append(server_filename)
+            results.append(server_filename)
+        if written:
+            self.ack_push_files(written, source_uname, source_ip, source_port)
+        return results
+
+    def rename_path(self, src, dest, source_uname, source_ip, source_port):
+        """Apply a client's rename to the mirror and log it for the other clients."""
+        my_src = self.safe_path(Base.get_dest_path(src, self.username, self.role))
+        my_dest = self.safe_path(Base.get_dest_path(dest, self.username, self.role))
+        if my_src is None or my_dest is None:
+            return False
+        if not os.path.lexists(my_src):
+            # Nothing to move here; the content reaches the new name through a normal push
+            return os.path.lexists(my_dest)
+        if not self.rename_local(my_src, my_dest):
+            return False
+        logger.debug("Renamed %s to %s for %s", my_src, my_dest, source_uname)
+        self.tree.touch(my_src)
+        self.tree.touch(my_dest)
+        self.changelog.append('rename', my_src, my_dest, origin=self.origin(source_uname, source_ip, source_port))
+        return True
+
+    def delete_path(self, path, source_uname, source_ip, source_port):
+        """Apply a client's delete to the mirror and log it for the other clients."""
+        my_path = self.safe_path(Base.get_dest_path(path, self.username, self.role))
+        if my_path is None:
+            return False
+        if not os.path.lexists(my_path):
+            return True
+        if not self.delete_local(my_path):
+            return False
+        logger.debug("Deleted %s for %s", my_path, source_uname)
+        self.tree.touch(my_path)
+        self.changelog.append('delete', my_path, origin=self.origin(source_uname, source_ip, source_port))
+        return True
+
+    def tree_nodes(self, rels):
+        """Return [path, hash, children] of the given mirror directories, for a client's reconcile."""
+        with self.tree.lock:
+            if not self.tree_loaded:
+                # The mirror may have changed while the server was down; rehash it once
+                self.tree.refresh()
+                self.tree.take_dirty()
+                self.tree_loaded = True
+            else:
+                self.tree.refresh(self.tree.take_dirty())
+            return self.tree.nodes(rels)
+
+    def resend_paths(self, rels, source_uname, source_ip, source_port):
+        """Log mirror files, or whole directories, found missing or stale on a client by its reconcile."""
+        origin = self.origin(source_uname, source_ip, source_port)
+        if origin is None:
+            return False
+        with self.changelog.batch():
+            for rel in rels:
+                path = self.safe_path(os.path.join(self.tree.base, rel))
+                if path is not None:
+                    self.resend(path, origin)
+        logger.debug("Logged %d paths for client %s after reconcile", len(rels), origin)
+        return True
+
+    def resend(self, path, client_id):
+        """Log the files at or under a mirror path to be sent again to one client."""
+        paths = [path] if not os.path.isdir(path) else \
+            [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        with self.changelog.batch():
+            for file_path in paths:
+                self.changelog.append('write', file_path, target=client_id)
+
+    def client_at(self, source_ip, source_port):
+        """Return the configured client at the given address, or None."""
+        return next((client for client in self.clients if (client.ip, client.port) == (source_ip, source_port)),
+                    None)
+
+    def origin(self, source_uname, source_ip, source_port):
+        """Return the id of the configured client at the given address, or None."""
+        client = self.client_at(source_ip, source_port)
+        return client.id if client is not None else None
+
+    def caught_up(self, source_uname, source_ip, source_port):
+        """Return True if a client has been sent every change in the changelog.
+
+        A client's reconcile waits for this, so files whose deletes or renames are still on their
+        way are not mistaken for local changes.
+        """
+        client = self.client_at(source_ip, source_port)
+        if client is None:
+            return False
+        return not client.pending and self.changelog.cursor(client.id) >= self.changelog.generation
+
+    def send_ops(self, client, ops):
+        """Send a client renames and deletes from the changelog, in order.
+
+        Returns False if the client could not be reached.
+        """
+        for op in ops:
+            if op[0] == 'rename':
+                status = sxmlr.rename_path(client.ip, client.port, self.get_client_path(op[1], client),
+                                           self.get_client_path(op[2], client), self.username, self.ip, self.port)
+            else:
+                status = sxmlr.delete_path(client.ip, client.port, self.get_client_path(op[1], client),
+                                           self.username, self.ip, self.port)
+            if status is None:
+                logger.error("Failed to send %s of %s to client %s", op[0], op[1], client.id)
+                return False
+            if op[0] == 'rename' and status is not True:
+                # The client could not rename its copy; send it the files under the new name instead
+                self.resend(op[2], client.id)
+        return True
+
+    def missing_chunks(self, digests):
+        """Return which of the given chunk digests the chunk store does not have."""
+        return self.chunks.missing(digests)
+
+    def put_chunks(self, chunks):
+        """Store uploaded chunks, sent as [digest, contents, compressed] triples."""
+        try:
+            for digest, payload, compressed in chunks:
+                if not self.chunks.put(digest, compression.unpack(payload.data, compressed)):
+                    return False
+        except (OSError, zlib.error) as e:
+            logger.error("Error storing uploaded chunks: %s", e)
+            return False
+        return True
+
+    def assemble_file(self, filename, recipe, digest):
+        """Build 'filename' from stored chunks, listed by digest in file order."""
+        filename = self.safe_path(filename)
+        if filename is None:
+            return False
+        try:
+            status = self.chunks.assemble(filename, recipe, digest)
+        except OSError as e:
+            logger.error("Error assembling %s: %s", filename, e)
+            return False
+        logger.debug("Assembled %s from %d chunks: %s", filename, len(recipe), status)
+        return status
 
     def collision_check(self, filedata):
         """Check for file collision based on modification time."""
@@ -98,38 +317,183 @@ class Server(Base):
         logger.debug("Collision check for file %s result %s", my_file, collision_exist)
         return collision_exist
 
+    @staticmethod
+    def get_client_path(filename, client):
+        """Map a file in the server's .tsync mirror to its path on the given client."""
+        return Base.get_dest_path(filename.replace("/.tsync", ""), client.uname, 'client')
+
+    def send_to_client(self, client, file):
+        """Bring one file from the mirror to a client, as a delta when possible; return True on success."""
+        client_file = self.get_client_path(file, client)
+        if not os.path.lexists(file):
+            # Removed from the mirror behind tsync's back; there is nothing left to send
+            logger.debug("%s is gone, not sending it to %s", file, client.uname)
+            return True
+        try:
+            if os.path.getsize(file) <= INLINE_MAX_SIZE:
+                with open(file, 'rb') as fp:
+                    payload, compressed = compression.pack(fp.read(), compression.compressible_type(file), client.ip)
+                return sxmlr.write_file_inline(client.ip, client.port, client_file, xmlrpc.client.Binary(payload),
+                                               compressed) is True
+        except OSError as e:
+            logger.error("Error reading %s: %s", file, e)
+            return False
+        if self.push_delta(file, client.ip, client.port, client_file):
+            return True
+        try:
+            large = os.path.getsize(file) >= chunked.CHUNKED_MIN_SIZE
+        except OSError:
+            return False
+        if large or sparse.is_sparse(file):
+            return self.push_chunked(file, client.ip, client.port, client_file)
+        compress = compression.should_compress(file, client.ip)
+        job_id = sxmlr.pull_file(client.ip, client.port, file, self.username, self.ip, compress)
+        if job_id is None:
+            return False
+        # The client pulls in the background; the transfer finishes when it reports the job
+        return self.pulls.expect(client.id, job_id)
+
+    def jobs_done(self, results, source_uname, source_ip, source_port):
+        """Resolve pulls a client has finished, given as [job id, ok] pairs."""
+        origin = self.origin(source_uname, source_ip, source_port)
+        if origin is None:
+            return False
+        for job_id, ok in results:
+            self.pulls.finish(origin, job_id, ok)
+        return True
+
+    def poll_jobs(self):
+        """Ask clients, one batched call each on the worker pool, about pulls they have not reported for a while."""
+        for client_id, job_ids in self.pulls.overdue().items():
+            client = next((client for client in self.clients if client.id == client_id), None)
+            if client is None or not client.available:
+                logger.error("Cannot ask %s about %d pulls; counting them as failed", client_id, len(job_ids))
+                self.pulls.fail(client_id)
+                continue
+            # Keyed per client, so polls of one client run one at a time
+            self.transfers.submit(client.id, (client.id, 'job_status'), self._poll_client_jobs, client, job_ids)
+
+    def _poll_client_jobs(self, client, job_ids):
+        statuses = sxmlr.job_status(client.ip, client.port, job_ids)
+        if statuses is None:
+            logger.error("Could not ask %s about %d pulls; counting them as failed", client.id, len(job_ids))
+            self.pulls.fail(client.id)
+            self.health.record(client.id, False)
+            return False
+        for job_id, status in zip(job_ids, statuses):
+            if status != 'running':
+                self.pulls.finish(client.id, job_id, status == 'done')
+        return True
+
+    def _client_file_done(self, client, generation, future):
+        """Record the outcome of a transfer started by catch_up."""
+        if future.exception() is not None or not future.result():
+            client.failed = True
+        with self.changelog.lock:
+            client.pending -= 1
+            if client.pending:
+                return
+        self.health.record(client.id, not client.failed)
+        if not client.failed:
+            self.advance(client, generation)
+
+    def _client_ops_done(self, client, generation, writes, future):
+        """Send the files of a catch-up once its renames and deletes went through."""
+        if future.exception() is not None or not future.result():
+            client.pending = 0
+            self.health.record(client.id, False)
+            return
+        if not writes:
+            client.pending = 0
+            self.health.record(client.id, True)
+            self.advance(client, generation)
+            return
+        with self.changelog.lock:
+            client.pending = len(writes)
+        for file in writes:
+            future = self.transfers.submit(client.id, (client.id, file), self.send_to_client, client, file)
+            future.add_done_callback(partial(self._client_file_done, client, generation))
+
+    def advance(self, client, generation):
+        """Record that a client has applied the changelog up to 'generation' and trim what all have."""
+        self.changelog.advance(client.id, generation)
+        self.changelog.trim([client.id for client in self.clients])
+        logger.debug("Client %s is at generation %d", client.id, generation)
+        self.work_ready.set()
+
+    def catch_up(self, client):
+        """Send a client the compacted changes since its generation: ops first, then files in parallel.
+
+        Everything runs on the worker pool, so an unreachable client never holds up the sync loop.
+        The client's generation moves forward once all of them have arrived; after a failure the
+        next round starts over from the old generation, which is harmless as every step is idempotent.
+        """
+        generation, ops, writes = self.changelog.since(self.changelog.cursor(client.id), client.id)
+        if generation == self.changelog.cursor(client.id):
+            return
+        logger.debug("Catching up client %s to generation %d: %d ops, %d files", client.id, generation,
+                     len(ops), len(writes))
+        # Renames and deletes go first so files land under their current names; until they have
+        # gone through, the pending count stands for the ops job
+        client.pending = 1
+        client.failed = False
+        future = self.transfers.submit(client.id, (client.id, 'ops'), self.send_ops, client, ops)
+        future.add_done_callback(partial(self._client_ops_done, client, generation, writes))
+
     def sync_files(self):
-        """Synchronize files with all available clients."""
+        """Synchronize files with all available clients.
+
+        Transfers run on the worker pool, so clients are served in parallel and a slow client only
+        holds up its own catch-up; a client is caught up again once its current one has finished.
+        """
         while True:
             try:
-                time.sleep(10)
+                # Sleep until a push is acknowledged or a client comes back; while some client is
+                # behind, also wake up periodically to retry
+                newest = self.changelog.generation
+                pending = any(self.changelog.cursor(client.id) < newest for client in self.clients)
+                self.work_ready.wait(SYNC_RETRY_INTERVAL if pending else None)
+                self.work_ready.clear()
+                time.sleep(SYNC_BATCH_WINDOW)
+                self.poll_jobs()
                 for client in self.clients:
-                    logger.debug("List of files for client %s, availability %s", client.uname, client.available)
-                    if client.available:
-                        for file in client.mfiles.list():
-                            rpc_status = sxmlr.pull_file(client.ip, client.port, file, self.username, self.ip)
-                            if rpc_status is None:
-                                client.available = False
-                                continue
-                            client.mfiles.remove(file)
-                            logger.debug("File synced: %s", file)
+                    logger.debug("Client %s at generation %d, availability %s", client.id,
+                                 self.changelog.cursor(client.id), client.available)
+                    if client.available and not client.pending:
+                        self.catch_up(client)
             except KeyboardInterrupt:
                 break
 
     def mark_presence(self, client_ip, client_port):
         """Mark client as available."""
         logger.debug("Mark presence call received from %s:%s", client_ip, client_port)
-        for client in self.clients:
-            if (client_ip, client_port) == (client.ip, client.port):
-                client.available = True
-                logger.debug("Client %s marked available", client.uname)
+        client = self.client_at(client_ip, client_port)
+        if client is not None:
+            # A client coming back gets its keys added by _client_health
+            if self.health.healthy(client.id):
                 self.add_client_keys(client)
+            self.health.record(client.id, True)
+            self.work_ready.set()
 
-    def find_available_clients(self):
-        """Check availability of all clients."""
-        for client in self.clients:
-            client.available = sxmlr.find_available(client.ip, client.port)
+    def probe_client(self, client_id):
+        """Return True if a client answers, within sxmlr.PROBE_TIMEOUT."""
+        client = next(client for client in self.clients if client.id == client_id)
+        return sxmlr.probe(client.ip, client.port)
+
+    def _client_health(self, client_id, healthy):
+        """Follow the health monitor: skip clients whose circuit is open, resume those that recover."""
+        client = next(client for client in self.clients if client.id == client_id)
+        client.available = healthy
+        if healthy:
+            logger.debug("Client %s marked available", client.id)
             self.add_client_keys(client)
+            self.work_ready.set()
+        else:
+            logger.debug("Client %s marked unavailable", client.id)
+
+    def find_available_clients(self):
+        """Check availability of all clients; the probes run concurrently in the background."""
+        self.health.check_now()
 
     def get_authfile(self):
         """Get the path to the authorized_keys file."""
@@ -164,4 +528,4 @@ class Server(Base):
     def activate(self):
         """Activate the server node."""
         super(Server, self).activate()
-        self.find_available_clients()
+        self.health.start()
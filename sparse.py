@@ -0,0 +1,67 @@
+import bisect
+import errno
+import os
+
+# Zero runs of this many bytes are left as holes instead of being written
+HOLE_BLOCK = 4096
+_ZEROS = bytes(HOLE_BLOCK)
+
+
+def is_sparse(path):
+    """Return True if a file has fewer blocks allocated than its size needs."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_blocks * 512 < st.st_size
+
+
+def data_extents(fd, start, end):
+    """Return the (start, end) ranges of fd between 'start' and 'end' that hold data.
+
+    Uses SEEK_DATA and SEEK_HOLE; where they are not supported the whole range is data.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(start, end)]
+    extents = []
+    pos = start
+    try:
+        while pos < end:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # Only a hole is left
+                raise
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            extents.append((data, hole))
+            pos = hole
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return [(start, end)]
+    return extents
+
+
+def has_data(extents, start, end):
+    """Return True if any of the sorted 'extents' overlaps [start, end)."""
+    i = bisect.bisect_right(extents, (start, float('inf'))) - 1
+    if i >= 0 and extents[i][1] > start:
+        return True
+    return i + 1 < len(extents) and extents[i + 1][0] < end
+
+
+def write_sparse(fp, data):
+    """Write data at the current position, seeking over zero blocks so they stay holes.
+
+    A trailing hole is not written, so the caller must truncate the file to its final size.
+    """
+    view = memoryview(data)
+    for pos in range(0, len(view), HOLE_BLOCK):
+        block = view[pos:pos + HOLE_BLOCK]
+        if block == _ZEROS[:len(block)]:
+            fp.seek(len(block), os.SEEK_CUR)
+        else:
+            fp.write(block)
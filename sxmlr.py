@@ -1,13 +1,121 @@
 import socket
 import errno
 import logging
+import threading
 import xmlrpc.client
+from contextlib import contextmanager
 from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import time
 
 logger = logging.getLogger('tsync')
 logger.setLevel(logging.DEBUG)
 
+# Close pooled connections idle for longer than this; keep it below base.KEEPALIVE_TIMEOUT so
+# the peer does not drop them first
+IDLE_TIMEOUT = 10
+MAX_IDLE_PER_PEER = 2
+# Seconds a health probe waits for a peer to answer
+PROBE_TIMEOUT = 2
+# Seconds a pooled call waits on a silent peer before failing, so no thread hangs on a vanished host
+CALL_TIMEOUT = 120
+# Calls whose work on the peer grows with a file or the tree, such as hashing or patching a large
+# file, can legitimately run far longer; they get this instead
+TRANSFER_TIMEOUT = 3600
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    """Transport whose connections give up after 'timeout' seconds.
+
+    The timeout can be changed between calls; it also applies to a kept-alive connection.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(self.timeout)
+        return connection
+
+
+class ConnectionPool:
+    """Thread-safe per-peer pool of keep-alive XML-RPC connections.
+
+    Each ServerProxy keeps its HTTP/1.1 connection open between calls and is lent to one caller
+    at a time. Connections that fail are closed instead of being returned to the pool.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_idle=MAX_IDLE_PER_PEER, timeout=CALL_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}  # (ip, port) -> [(last used, proxy)], most recently used last
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _close(proxy):
+        proxy('close')()
+
+    def _acquire(self, ip, port):
+        now = time.monotonic()
+        expired = []
+        proxy = None
+        with self.lock:
+            for key, entries in self.idle.items():
+                fresh = [(used, p) for used, p in entries if now - used < self.idle_timeout]
+                expired.extend(p for used, p in entries if now - used >= self.idle_timeout)
+                self.idle[key] = fresh
+            entries = self.idle.get((ip, port))
+            if entries:
+                _, proxy = entries.pop()
+        for stale in expired:
+            self._close(stale)
+        if proxy is None:
+            proxy = xmlrpc.client.ServerProxy(f"http://{ip}:{port}/", transport=TimeoutTransport(self.timeout),
+                                              allow_none=True)
+        return proxy
+
+    def _release(self, ip, port, proxy):
+        with self.lock:
+            entries = self.idle.setdefault((ip, port), [])
+            if len(entries) < self.max_idle:
+                entries.append((time.monotonic(), proxy))
+                return
+        self._close(proxy)
+
+    @contextmanager
+    def connection(self, ip, port, timeout=None):
+        """Borrow a connection to ip:port for the duration of the block.
+
+        Calls made on it wait 'timeout' seconds for an answer, the pool's default if None.
+        """
+        proxy = self._acquire(ip, port)
+        proxy('transport').timeout = self.timeout if timeout is None else timeout
+        try:
+            yield proxy
+        except xmlrpc.client.Fault:
+            # The remote call failed but the connection itself is fine
+            self._release(ip, port, proxy)
+            raise
+        except BaseException:
+            self._close(proxy)
+            raise
+        self._release(ip, port, proxy)
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self.lock:
+            entries = [proxy for peer in self.idle.values() for _, proxy in peer]
+            self.idle.clear()
+        for proxy in entries:
+            self._close(proxy)
+
+
+pool = ConnectionPool()
+
 
 def make_safer(fn):
     def wrapped(*args):
@@ -18,6 +126,10 @@ def make_safer(fn):
                 if result is None:
                     result = "Success"
                 return result
+            except socket.timeout as e:
+                # The peer is silent rather than refusing; waiting again would only double the stall
+                logger.error("RPC function '%s' on %s:%s timed out: %s", fn.__name__, args[0], args[1], e)
+                return None
             except socket.error as e:
                 if e.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH):
                     logger.critical("Connection error while calling RPC function '%s': %s", fn.__name__, str(e))
@@ -25,6 +137,11 @@ def make_safer(fn):
                                     attempt + 1, retries)
                     time.sleep(2)  # wait before retrying
                     continue
+                elif isinstance(e, ConnectionError):
+                    # A pooled connection broke; the pool has dropped it, so retry on a fresh one
+                    logger.debug("Connection to %s:%s lost during '%s', reconnecting", args[0], args[1],
+                                 fn.__name__)
+                    continue
                 else:
                     raise
             except Exception as e:
@@ -35,48 +152,202 @@ def make_safer(fn):
     return wrapped
 
 
+# The wrappers below pass sizes, offsets and byte counts as strings, since XML-RPC integers are
+# limited to 32 bits
+
+
 @make_safer
-def pull_file(dest_ip, dest_port, filename, source_uname, source_ip):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
-    logger.info("Logging from pull file of sxmlr on filename %s, source ip : %s, destination ip: %s", filename,
-                source_ip, dest_ip)
-    return connect.pull_file(filename, source_uname, source_ip)
+def pull_file(dest_ip, dest_port, filename, source_uname, source_ip, compress=False):
+    with pool.connection(dest_ip, dest_port) as connect:
+        logger.info("Logging from pull file of sxmlr on filename %s, source ip : %s, destination ip: %s", filename,
+                    source_ip, dest_ip)
+        return connect.pull_file(filename, source_uname, source_ip, compress)
 
 
 @make_safer
 def req_push_file(dest_ip, dest_port, filename, source_uname, source_ip, source_port):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
-    return connect.req_push_file(filename, source_uname, source_ip, source_port)
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.req_push_file(filename, source_uname, source_ip, source_port)
 
 
 @make_safer
 def ack_push_file(dest_ip, dest_port, filename, source_uname, source_ip, source_port):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
-    return connect.ack_push_file(filename, source_uname, source_ip, source_port)
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.ack_push_file(filename, source_uname, source_ip, source_port)
 
 
 @make_safer
 def mark_presence(dest_ip, dest_port, source_ip, source_port):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
-    logger.debug("RPC call to mark presence")
-    logger.debug("Available methods on RPC server: %s", connect.system.listMethods())
-    connect.mark_presence(source_ip, source_port)
+    with pool.connection(dest_ip, dest_port) as connect:
+        logger.debug("RPC call to mark presence")
+        connect.mark_presence(source_ip, source_port)
 
 
 @make_safer
 def get_client_public_key(dest_ip, dest_port):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
-    return connect.get_public_key()
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.get_public_key()
 
 
-@make_safer
-def find_available(dest_ip, dest_port):
-    connect = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", allow_none=True)
+def probe(dest_ip, dest_port, timeout=PROBE_TIMEOUT):
+    """Return True if the peer answers a call within 'timeout' seconds.
+
+    Unlike the wrapped calls it is tried once, on a connection of its own, so a dead peer costs
+    at most 'timeout'.
+    """
+    proxy = xmlrpc.client.ServerProxy(f"http://{dest_ip}:{dest_port}/", transport=TimeoutTransport(timeout))
     try:
-        connect.system.listMethods()
+        proxy.system.listMethods()
         return True
-    except socket.error as e:
-        if e.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH):
-            return False
-        else:
-            raise
+    except xmlrpc.client.Fault:
+        return True  # It answered
+    except (OSError, xmlrpc.client.Error) as e:
+        logger.debug("Probe of %s:%s failed: %s", dest_ip, dest_port, e)
+        return False
+    finally:
+        proxy('close')()
+
+
+@make_safer
+def find_available(dest_ip, dest_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        try:
+            connect.system.listMethods()
+            return True
+        except socket.error as e:
+            if e.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH):
+                return False
+            else:
+                raise
+
+
+@make_safer
+def get_signature(dest_ip, dest_port, filename):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.get_signature(filename)
+
+
+@make_safer
+def apply_delta(dest_ip, dest_port, filename, block_size, payload, digest):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.apply_delta(filename, block_size, payload, digest)
+
+
+@make_safer
+def req_push_files(dest_ip, dest_port, manifest, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.req_push_files(manifest, source_uname, source_ip, source_port)
+
+
+@make_safer
+def ack_push_files(dest_ip, dest_port, filenames, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.ack_push_files(filenames, source_uname, source_ip, source_port)
+
+
+@make_safer
+def push_files_inline(dest_ip, dest_port, entries, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.push_files_inline(entries, source_uname, source_ip, source_port)
+
+
+@make_safer
+def write_file_inline(dest_ip, dest_port, filename, payload, compressed):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.write_file_inline(filename, payload, compressed)
+
+
+@make_safer
+def get_compression_stats(dest_ip, dest_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.get_compression_stats()
+
+
+@make_safer
+def begin_chunked(dest_ip, dest_port, filename, size, digest, chunk_size):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.begin_chunked(filename, size, digest, chunk_size)
+
+
+@make_safer
+def put_chunk(dest_ip, dest_port, filename, index, payload, digest, compressed):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.put_chunk(filename, index, payload, digest, compressed)
+
+
+@make_safer
+def put_holes(dest_ip, dest_port, filename, index, count):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.put_holes(filename, index, count)
+
+
+@make_safer
+def finish_chunked(dest_ip, dest_port, filename):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.finish_chunked(filename)
+
+
+@make_safer
+def missing_chunks(dest_ip, dest_port, digests):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.missing_chunks(digests)
+
+
+@make_safer
+def put_chunks(dest_ip, dest_port, chunks):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.put_chunks(chunks)
+
+
+@make_safer
+def assemble_file(dest_ip, dest_port, filename, recipe, digest):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.assemble_file(filename, recipe, digest)
+
+
+@make_safer
+def rename_path(dest_ip, dest_port, src, dest, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.rename_path(src, dest, source_uname, source_ip, source_port)
+
+
+@make_safer
+def delete_path(dest_ip, dest_port, path, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.delete_path(path, source_uname, source_ip, source_port)
+
+
+@make_safer
+def append_file(dest_ip, dest_port, filename, start, offset, payload, compressed, digest):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.append_file(filename, start, offset, payload, compressed, digest)
+
+
+@make_safer
+def tree_nodes(dest_ip, dest_port, rels):
+    with pool.connection(dest_ip, dest_port, TRANSFER_TIMEOUT) as connect:
+        return connect.tree_nodes(rels)
+
+
+@make_safer
+def resend_paths(dest_ip, dest_port, rels, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.resend_paths(rels, source_uname, source_ip, source_port)
+
+
+@make_safer
+def caught_up(dest_ip, dest_port, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.caught_up(source_uname, source_ip, source_port)
+
+
+@make_safer
+def jobs_done(dest_ip, dest_port, results, source_uname, source_ip, source_port):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.jobs_done(results, source_uname, source_ip, source_port)
+
+
+@make_safer
+def job_status(dest_ip, dest_port, job_ids):
+    with pool.connection(dest_ip, dest_port) as connect:
+        return connect.job_status(job_ids)
@@ -0,0 +1,91 @@
+from changelog import ChangeLog
+
+
+def make_log(tmp_path):
+    return ChangeLog(str(tmp_path / 'changelog.pkl'))
+
+
+def test_repeated_writes_collapse(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', origin='c1')
+    log.append('write', '/m/b', origin='c1')
+    log.append('write', '/m/a', origin='c1')
+    assert log.since(0, 'c2') == (3, [], ['/m/b', '/m/a'])
+
+
+def test_own_writes_are_not_sent_back(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', origin='c1')
+    log.append('write', '/m/b', origin='c2')
+    assert log.since(0, 'c1') == (2, [], ['/m/b'])
+
+
+def test_rename_carries_pending_writes(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/dir/x', origin='c1')
+    log.append('write', '/m/old', origin='c1')
+    log.append('rename', '/m/dir', '/m/dir2', origin='c1')
+    generation, ops, writes = log.since(0, 'c2')
+    assert ops == [('rename', '/m/dir', '/m/dir2')]
+    assert sorted(writes) == ['/m/dir2/x', '/m/old']
+
+
+def test_rename_over_a_pending_write_drops_it(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', origin='c1')
+    log.append('write', '/m/b', origin='c1')
+    log.append('rename', '/m/a', '/m/b', origin='c1')
+    assert log.since(0, 'c2')[2] == ['/m/b']
+
+
+def test_delete_drops_pending_writes_below(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/dir/x', origin='c1')
+    log.append('write', '/m/keep', origin='c1')
+    log.append('delete', '/m/dir', origin='c1')
+    assert log.since(0, 'c2') == (3, [('delete', '/m/dir')], ['/m/keep'])
+
+
+def test_targeted_changes_reach_only_their_client(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', target='c1')
+    assert log.since(0, 'c1')[2] == ['/m/a']
+    assert log.since(0, 'c2') == (1, [], [])
+
+
+def test_since_starts_after_the_given_generation(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', origin='c1')
+    log.append('write', '/m/b', origin='c1')
+    assert log.since(1, 'c2') == (2, [], ['/m/b'])
+    assert log.since(2, 'c2') == (2, [], [])
+
+
+def test_trim_keeps_what_a_client_still_needs(tmp_path):
+    log = make_log(tmp_path)
+    for name in 'abc':
+        log.append('write', '/m/' + name, origin='c1')
+    log.advance('c1', 3)
+    log.advance('c2', 2)
+    log.trim(['c1', 'c2'])
+    assert sorted(log.set) == [2, 3]
+    assert log.since(2, 'c2') == (3, [], ['/m/c'])
+
+
+def test_cursors_only_move_forward(tmp_path):
+    log = make_log(tmp_path)
+    log.advance('c1', 5)
+    log.advance('c1', 3)
+    assert log.cursor('c1') == 5
+    assert log.cursor('c2') == 0
+
+
+def test_changes_and_cursors_survive_a_restart(tmp_path):
+    log = make_log(tmp_path)
+    log.append('write', '/m/a', origin='c1')
+    log.append('rename', '/m/a', '/m/b', origin='c1')
+    log.advance('c2', 1)
+    reloaded = make_log(tmp_path)
+    assert reloaded.generation == 2
+    assert reloaded.cursor('c2') == 1
+    assert reloaded.since(0, 'c2') == log.since(0, 'c2')
@@ -0,0 +1,25 @@
+import os
+
+import compression
+
+
+def test_pack_leaves_data_alone_unless_told_to_compress():
+    data = b'text ' * 10000
+    assert compression.pack(data, False) == (data, False)
+    payload, compressed = compression.pack(data, True)
+    assert compressed and len(payload) < len(data)
+    assert compression.unpack(payload, compressed) == data
+
+
+def test_pack_sends_incompressible_data_as_it_is():
+    data = os.urandom(64 * 1024)
+    assert compression.pack(data, True) == (data, False)
+
+
+def test_compressed_formats_are_not_sampled(tmp_path):
+    photo, notes = tmp_path / 'photo.JPG', tmp_path / 'notes.txt'
+    photo.write_bytes(b'a' * 100000)
+    notes.write_bytes(b'a' * 100000)
+    assert not compression.compressible_type(str(photo))
+    assert not compression.should_compress(str(photo))
+    assert compression.should_compress(str(notes))
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from debouncer import Debouncer
+
+SETTLE = 0.05
+
+
+class Released:
+    def __init__(self):
+        self.paths = []
+        self.at = None
+        self.event = threading.Event()
+
+    def __call__(self, path):
+        self.paths.append(path)
+        self.at = time.monotonic()
+        self.event.set()
+
+    def wait(self, timeout=2):
+        """Wait for a release, then long enough for any other pending path to come due."""
+        assert self.event.wait(timeout)
+        time.sleep(SETTLE * 4)
+        return self.paths
+
+
+def started(released):
+    debouncer = Debouncer(released, SETTLE)
+    debouncer.start()
+    return debouncer
+
+
+def test_burst_of_touches_is_released_once():
+    released = Released()
+    debouncer = started(released)
+    for _ in range(5):
+        debouncer.touch('/w/a')
+        time.sleep(SETTLE / 5)
+    assert released.wait() == ['/w/a']
+    assert debouncer.pending() == 0
+
+
+def test_touch_pushes_the_release_back():
+    released = Released()
+    debouncer = started(released)
+    debouncer.touch('/w/a')
+    time.sleep(SETTLE / 2)
+    touched = time.monotonic()
+    debouncer.touch('/w/a')
+    assert released.wait() == ['/w/a']
+    assert released.at - touched >= SETTLE
+
+
+def test_shorter_delay_moves_the_release_forward():
+    released = Released()
+    debouncer = started(released)
+    debouncer.touch('/w/a', delay=60)
+    debouncer.touch('/w/a', delay=0)
+    assert released.wait() == ['/w/a']
+
+
+def test_cancelled_and_moved_paths():
+    released = Released()
+    debouncer = started(released)
+    debouncer.touch('/w/gone')
+    debouncer.touch('/w/dir/a')
+    debouncer.cancel('/w/gone')
+    debouncer.move('/w/dir', '/w/renamed')
+    assert released.wait() == ['/w/renamed/a']
@@ -0,0 +1,94 @@
+import os
+import random
+
+import delta
+from paths import TEMP_PREFIX
+
+
+def round_trip(tmp_path, old, new, **kwargs):
+    basis, target, out = tmp_path / 'basis', tmp_path / 'target', tmp_path / 'out'
+    basis.write_bytes(old)
+    target.write_bytes(new)
+    block_size, signature = delta.file_signature(str(basis))
+    payload = delta.compute_delta(str(target), block_size, signature, **kwargs)
+    if payload is None:
+        return None
+    delta.apply_delta(str(basis), payload, block_size, str(out), delta.file_digest(str(target)))
+    return out.read_bytes(), payload
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_identical_file_is_all_copies(tmp_path):
+    data = random_bytes(300 * 1024)
+    rebuilt, payload = round_trip(tmp_path, data, data)
+    assert rebuilt == data
+    assert len(payload) < 100
+
+
+def test_edits_insertions_and_deletions(tmp_path):
+    old = random_bytes(500 * 1024)
+    new = old[:1000] + b'inserted' + old[1000:200000] + b'X' * 50 + old[200050:400000] + old[410000:]
+    rebuilt, payload = round_trip(tmp_path, old, new)
+    assert rebuilt == new
+    assert len(payload) < 50 * 1024
+
+
+def test_appended_and_truncated_files(tmp_path):
+    old = random_bytes(256 * 1024)
+    assert round_trip(tmp_path, old, old + b'tail' * 1000)[0] == old + b'tail' * 1000
+    assert round_trip(tmp_path, old, old[:100001])[0] == old[:100001]
+
+
+def test_empty_target(tmp_path):
+    assert round_trip(tmp_path, random_bytes(128 * 1024), b'')[0] == b''
+
+
+def test_zero_runs_come_back_as_zeros(tmp_path):
+    old = random_bytes(128 * 1024)
+    new = old[:64 * 1024] + bytes(200 * 1024) + old[64 * 1024:]
+    assert round_trip(tmp_path, old, new)[0] == new
+
+
+def test_rewritten_file_gives_up_once_mostly_literal(tmp_path):
+    old = random_bytes(512 * 1024, seed=1)
+    new = random_bytes(512 * 1024, seed=2)
+    assert round_trip(tmp_path, old, new, probe_size=128 * 1024) is None
+    # Below the probe size only the absolute limit applies
+    rebuilt, _ = round_trip(tmp_path, old, new, probe_size=1024 * 1024)
+    assert rebuilt == new
+
+
+def test_wrong_digest_leaves_the_file_alone(tmp_path):
+    basis, target, out = tmp_path / 'basis', tmp_path / 'target', tmp_path / 'out'
+    old = random_bytes(128 * 1024)
+    basis.write_bytes(old)
+    target.write_bytes(old + b'more')
+    out.write_bytes(b'previous')
+    block_size, signature = delta.file_signature(str(basis))
+    payload = delta.compute_delta(str(target), block_size, signature)
+    try:
+        delta.apply_delta(str(basis), payload, block_size, str(out), 'not the digest')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a mismatching digest was accepted")
+    assert out.read_bytes() == b'previous'
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(TEMP_PREFIX + 'delta-')]
+
+
+def test_prefix_hash_matches_file_and_data_digests(tmp_path):
+    data = random_bytes(200 * 1024)
+    path = tmp_path / 'file'
+    path.write_bytes(data + b'appended')
+    assert delta.prefix_hash(str(path), len(data)).hexdigest() == delta.data_digest(data)
+    assert delta.prefix_hash(str(path), 100).hexdigest() == delta.data_digest(data[:100])
+    assert delta.prefix_hash(str(path), len(data) + 8).hexdigest() == delta.file_digest(str(path))
+    try:
+        delta.prefix_hash(str(path), len(data) + 9)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a prefix longer than the file was hashed")
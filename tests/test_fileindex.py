@@ -0,0 +1,62 @@
+import delta
+from fileindex import FileIndex
+
+
+def synced_index(tmp_path, data):
+    path = tmp_path / 'log'
+    path.write_bytes(data)
+    index = FileIndex(str(tmp_path / 'index.pkl'))
+    index.update(str(path))
+    return index, path
+
+
+def test_appended_file_gives_the_synced_prefix(tmp_path):
+    index, path = synced_index(tmp_path, b'first line\n')
+    with open(path, 'ab') as fp:
+        fp.write(b'second line\n')
+    size, prefix = index.appended(str(path))
+    assert size == len(b'first line\n')
+    prefix.update(b'second line\n')
+    assert prefix.hexdigest() == index._digest(str(path))
+
+
+def test_unchanged_or_rewritten_file_is_not_an_append(tmp_path):
+    index, path = synced_index(tmp_path, b'x' * 200 * 1024)
+    assert index.appended(str(path)) is None
+    # Only the start differs, far from where the synced prefix ends
+    with open(path, 'r+b') as fp:
+        fp.write(b'y')
+    with open(path, 'ab') as fp:
+        fp.write(b'more')
+    assert index.appended(str(path)) is None
+
+
+def test_append_after_a_partial_sync(tmp_path):
+    index, path = synced_index(tmp_path, b'')
+    path.write_bytes(b'abcdef')
+    # The peer got only the first three bytes before the file grew
+    index.update(str(path), sent=(3, delta.data_digest(b'abc')))
+    size, prefix = index.appended(str(path))
+    assert (size, prefix.hexdigest()) == (3, delta.data_digest(b'abc'))
+
+
+def test_scan_reports_synced_paths_deleted_since_the_last_scan(tmp_path):
+    root = tmp_path / 'sync'
+    (root / 'docs').mkdir(parents=True)
+    (root / 'notes').write_bytes(b'synced')
+    (root / 'draft').write_bytes(b'never synced')
+    (root / 'docs' / 'report').write_bytes(b'synced')
+    index = FileIndex(str(tmp_path / 'index.pkl'))
+    changed, deleted = index.scan([str(root)])
+    assert len(changed) == 3 and deleted == []
+    index.update(str(root / 'notes'))
+    index.update(str(root / 'docs' / 'report'))
+
+    (root / 'notes').unlink()
+    (root / 'draft').unlink()
+    (root / 'docs' / 'report').unlink()
+    (root / 'docs').rmdir()
+    changed, deleted = index.scan([str(root)])
+    assert changed == []
+    assert sorted(deleted) == [str(root / 'docs'), str(root / 'notes')]
+    assert index.get(str(root / 'docs' / 'report')) is None
@@ -0,0 +1,36 @@
+from filepersistentset import FilesPersistentSet
+
+
+def test_repeat_changes_collapse_into_the_latest(tmp_path):
+    queue = FilesPersistentSet(str(tmp_path / 'queue.pkl'))
+    queue.add('/w/a', 2.0)
+    queue.add('/w/a', 1.0)
+    queue.add('/w/a', 3.0)
+    assert [(f.name, f.time) for f in queue.list()] == [('/w/a', 3.0)]
+
+
+def test_remove_keeps_a_file_modified_again_since(tmp_path):
+    pkl = str(tmp_path / 'queue.pkl')
+    queue = FilesPersistentSet(pkl)
+    queue.add('/w/a', 1.0)
+    queue.add('/w/b', 1.0)
+    # The sync of the version from time 1.0 finishes after /w/a changed again
+    queue.add('/w/a', 2.0)
+    queue.remove('/w/a', 1.0)
+    queue.remove('/w/b', 1.0)
+    assert queue.get('/w/a').time == 2.0
+    assert queue.get('/w/b') is None
+    queue.remove('/w/a')
+    assert len(queue) == 0
+    queue.remove('/w/missing', 1.0)
+    assert len(FilesPersistentSet(pkl)) == 0
+
+
+def test_move_requeues_entries_under_the_new_name(tmp_path):
+    pkl = str(tmp_path / 'queue.pkl')
+    queue = FilesPersistentSet(pkl)
+    queue.add('/w/dir/a', 1.0)
+    queue.add('/w/dir2', 1.0)
+    queue.move('/w/dir', '/w/renamed')
+    queue.move('/w/dir2')
+    assert [(f.name, f.time) for f in FilesPersistentSet(pkl).list()] == [('/w/renamed/a', 1.0)]
@@ -0,0 +1,26 @@
+from merkle import compare_child
+
+
+def test_directories_on_both_sides_are_descended_into():
+    assert compare_child(('d', 'a'), ('d', 'b'), False) == 'descend'
+
+
+def test_file_changed_here_is_pushed():
+    assert compare_child(('f', 'new'), ('f', 'old'), False) == 'push'
+    assert compare_child(('f', 'new'), None, False) == 'push'
+
+
+def test_file_changed_only_on_the_server_is_fetched():
+    assert compare_child(('f', 'old'), ('f', 'new'), True) == 'fetch'
+    assert compare_child(None, ('f', 'new'), False) == 'fetch'
+    assert compare_child(None, ('d', 'new'), False) == 'fetch'
+
+
+def test_file_deleted_on_the_server_is_left_alone():
+    assert compare_child(('f', 'old'), None, True) is None
+
+
+def test_kind_changed_on_one_side():
+    # A local directory where the server has a file, or the other way round
+    assert compare_child(('d', 'a'), ('f', 'b'), False) == 'push'
+    assert compare_child(('f', 'a'), ('d', 'b'), False) == 'push'
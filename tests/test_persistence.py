@@ -0,0 +1,81 @@
+import os
+
+from persistence import PersistentDict, PersistentSet
+
+
+def test_changes_survive_a_restart(tmp_path):
+    pkl = str(tmp_path / 'set.pkl')
+    items = PersistentSet(pkl)
+    items.add('a')
+    items.add('b')
+    items.remove('a')
+    assert set(PersistentSet(pkl).list()) == {'b'}
+
+
+def test_torn_journal_record_is_cut_off(tmp_path):
+    pkl = str(tmp_path / 'set.pkl')
+    items = PersistentSet(pkl)
+    with items.batch():
+        items.add('a')
+        items.add('b')
+    journal = pkl + '.journal'
+    good_size = os.path.getsize(journal)
+    # A crash in the middle of writing the next record leaves part of it behind
+    items.add('c')
+    with open(journal, 'r+b') as fp:
+        fp.truncate(good_size + (os.path.getsize(journal) - good_size) // 2)
+
+    reloaded = PersistentSet(pkl)
+    assert set(reloaded.list()) == {'a', 'b'}
+    # The torn record is gone, so records written after it are read back too
+    reloaded.add('d')
+    assert set(PersistentSet(pkl).list()) == {'a', 'b', 'd'}
+
+
+def test_garbage_after_the_last_record_is_cut_off(tmp_path):
+    pkl = str(tmp_path / 'set.pkl')
+    PersistentSet(pkl, compact_threshold=100).add('a')
+    with open(pkl + '.journal', 'ab') as fp:
+        fp.write(b'\x80\x04garbage')
+    assert PersistentSet(pkl).list() == ['a']
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    pkl = str(tmp_path / 'set.pkl')
+    items = PersistentSet(pkl, compact_threshold=4)
+    for n in range(10):
+        items.add(n)
+        items.remove(n)
+    items.add('kept')
+    assert os.path.exists(pkl)
+    assert items._journal_records <= 4
+    assert PersistentSet(pkl).list() == ['kept']
+
+
+def test_timestamp_is_kept(tmp_path):
+    pkl = str(tmp_path / 'set.pkl')
+    items = PersistentSet(pkl)
+    assert items.get_modified_timestamp() == 0
+    items.update_modified_timestamp()
+    stamp = items.get_modified_timestamp()
+    items._compact()
+    assert PersistentSet(pkl).get_modified_timestamp() == stamp
+
+
+class Store(PersistentDict):
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+
+def test_dict_entries_survive_restart_and_compaction(tmp_path):
+    pkl = str(tmp_path / 'dict.pkl')
+    store = Store(pkl)
+    store.put('a', 1)
+    store.put('b', 2)
+    store.put('a', 3)
+    store.remove('b')
+    store.remove('missing')
+    assert Store(pkl).set == {'a': 3}
+    store._compact()
+    assert Store(pkl).set == {'a': 3}
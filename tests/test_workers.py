@@ -0,0 +1,61 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from workers import TransferWorkers
+
+
+def test_jobs_with_the_same_key_run_one_at_a_time_in_order():
+    workers = TransferWorkers(max_workers=4, per_peer=4)
+    order, running, overlaps = [], set(), []
+    lock = threading.Lock()
+
+    def job(n):
+        with lock:
+            if 'same' in running:
+                overlaps.append(n)
+            running.add('same')
+        time.sleep(0.01)
+        with lock:
+            running.discard('same')
+            order.append(n)
+        return n
+
+    futures = [workers.submit('peer', '/dest/a', job, n) for n in range(6)]
+    assert [future.result(timeout=5) for future in futures] == list(range(6))
+    assert order == list(range(6)) and overlaps == []
+    workers.shutdown()
+
+
+def test_different_keys_run_side_by_side():
+    workers = TransferWorkers(max_workers=4, per_peer=4)
+    barrier = threading.Barrier(2, timeout=5)
+    futures = [workers.submit('peer', key, barrier.wait) for key in ('/dest/a', '/dest/b')]
+    assert sorted(future.result(timeout=5) for future in futures) == [0, 1]
+    workers.shutdown()
+
+
+def test_key_stays_held_until_a_returned_future_finishes():
+    workers = TransferWorkers(max_workers=2, per_peer=2)
+    background = Future()
+    first = workers.submit('peer', '/dest/a', lambda: background)
+    second = workers.submit('peer', '/dest/a', lambda: 'second')
+    other = workers.submit('peer', '/dest/b', lambda: 'other')
+    # The first job's worker is free again, so other keys go ahead, but its key is still held
+    assert other.result(timeout=5) == 'other'
+    time.sleep(0.05)
+    assert not second.done()
+    background.set_result('first')
+    assert first.result(timeout=5) == 'first'
+    assert second.result(timeout=5) == 'second'
+    workers.shutdown()
+
+
+def test_per_peer_cap_leaves_room_for_other_peers():
+    workers = TransferWorkers(max_workers=2, per_peer=1)
+    gate = threading.Event()
+    slow = [workers.submit('slow', f'/slow/{n}', gate.wait, 5) for n in range(3)]
+    assert workers.submit('fast', '/fast', lambda: 'done').result(timeout=5) == 'done'
+    gate.set()
+    assert all(future.result(timeout=5) for future in slow)
+    workers.shutdown()
@@ -0,0 +1,166 @@
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Keep the shared SSH connection to a peer open this many seconds after its last transfer
+CONTROL_PERSIST = 600
+CONTROL_DIR = os.path.expanduser('~/.ssh')
+# gzip level of compressed archives; anything higher costs far more CPU than it saves on the wire
+ARCHIVE_LEVEL = 1
+
+
+def stream_archive(entries, args, compress=False):
+    """Pack local files into a tar stream piped to the extracting command 'args'.
+
+    'entries' holds (local path, destination path) pairs; members are named after their
+    destination, relative to '/', so the receiver unpacks them into place as they arrive.
+    With 'compress', the stream is gzipped at ARCHIVE_LEVEL. Returns the exit status of the
+    command, or 1 if the stream could not be written.
+    """
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+    try:
+        # Stream-mode tarfile always gzips at level 9, so compression is layered on by hand
+        stream = gzip.GzipFile(fileobj=proc.stdin, mode='wb', compresslevel=ARCHIVE_LEVEL) if compress else proc.stdin
+        with stream, tarfile.open(fileobj=stream, mode='w|') as archive:
+            for filename, dest_path in entries:
+                try:
+                    archive.add(filename, arcname=dest_path.lstrip('/'), recursive=False)
+                except FileNotFoundError:
+                    logger.debug("File %s vanished before it could be archived", filename)
+    except OSError as e:
+        logger.error("Error streaming archive of %d files: %s", len(entries), e)
+        proc.kill()
+        proc.wait()
+        return 1
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+    return proc.wait()
+
+
+def extract_args(compress):
+    """Return the tar command that unpacks a stream from stream_archive."""
+    return ['tar', '-xzf' if compress else '-xf', '-', '-C', '/']
+
+
+class ScpTransport:
+    """Copy files to and from one peer with scp over a single multiplexed SSH connection.
+
+    The first transfer starts an SSH ControlMaster; later ones attach to it and skip the
+    handshake and key exchange.
+    """
+
+    def __init__(self, uname, ip):
+        self.uname = uname
+        self.ip = ip
+        self.control_path = os.path.join(CONTROL_DIR, f"tsync-{uname}@{ip}")
+        # ssh fixes compression when a connection is set up, so compressed transfers get their own
+        self.compressed_control_path = f"{self.control_path}-z"
+
+    def ssh_options(self, compress=False):
+        """Return the options that make ssh/scp share the peer's (compressed) control connection."""
+        return ['-o', 'ControlMaster=auto',
+                '-o', f"ControlPath={self.compressed_control_path if compress else self.control_path}",
+                '-o', f"ControlPersist={CONTROL_PERSIST}",
+                '-o', f"Compression={'yes' if compress else 'no'}"]
+
+    def _run(self, args):
+        proc = subprocess.Popen(args)
+        return proc.wait()
+
+    def push(self, filename, dest_path, compress=False):
+        """Copy a local file to dest_path on the peer and return scp's exit status."""
+        return self._run(['scp'] + self.ssh_options(compress) + [filename, f"{self.uname}@{self.ip}:{dest_path}"])
+
+    def pull(self, source_path, filename, compress=False):
+        """Copy source_path from the peer to a local file and return scp's exit status."""
+        return self._run(['scp'] + self.ssh_options(compress) +
+                         [f"{self.uname}@{self.ip}:{source_path}", filename])
+
+    def push_archive(self, entries, compress=False):
+        """Stream many files to the peer as one tar archive over the shared connection."""
+        return stream_archive(entries, ['ssh'] + self.ssh_options() + [f"{self.uname}@{self.ip}"] +
+                              extract_args(compress), compress)
+
+    def close(self):
+        """Shut down the shared connections, if any are running."""
+        for control_path in (self.control_path, self.compressed_control_path):
+            if os.path.exists(control_path):
+                self._run(['ssh', '-o', f"ControlPath={control_path}", '-O', 'exit', f"{self.uname}@{self.ip}"])
+
+
+class LocalTransport:
+    """Stand-in for ScpTransport that copies on the local filesystem, for loopback testing."""
+
+    def __init__(self, uname, ip):
+        self.uname = uname
+        self.ip = ip
+
+    @staticmethod
+    def _copy(source, dest):
+        try:
+            shutil.copy2(source, dest)
+        except OSError as e:
+            logger.error("Local copy of %s to %s failed: %s", source, dest, e)
+            return 1
+        return 0
+
+    def push(self, filename, dest_path, compress=False):
+        """Copy filename to dest_path and return 0 on success."""
+        return self._copy(filename, dest_path)
+
+    def pull(self, source_path, filename, compress=False):
+        """Copy source_path to filename and return 0 on success."""
+        return self._copy(source_path, filename)
+
+    def push_archive(self, entries, compress=False):
+        """Unpack a tar stream of many files on this machine."""
+        return stream_archive(entries, extract_args(compress), compress)
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {
+    'scp': ScpTransport,
+    'local': LocalTransport,
+}
+
+
+class TransferPool:
+    """Hand out one long-lived transport per peer so its transfers share a connection."""
+
+    def __init__(self, transport_class=ScpTransport):
+        self.transport_class = transport_class
+        self.transports = {}
+        self.lock = threading.Lock()
+
+    def get(self, uname, ip):
+        """Return the transport for uname@ip, creating it on first use."""
+        with self.lock:
+            transport = self.transports.get((uname, ip))
+            if transport is None:
+                transport = self.transport_class(uname, ip)
+                self.transports[(uname, ip)] = transport
+                logger.debug("New %s for %s@%s", self.transport_class.__name__, uname, ip)
+            return transport
+
+    def close_all(self):
+        """Close every pooled transport."""
+        with self.lock:
+            transports = list(self.transports.values())
+            self.transports.clear()
+        for transport in transports:
+            transport.close()
+
+
+pool = TransferPool()
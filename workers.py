@@ -0,0 +1,117 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger('tsync')
+logger.setLevel(logging.DEBUG)
+
+# Transfers running at once in total, and at most this many per peer
+TRANSFER_WORKERS = 8
+PER_PEER_TRANSFERS = 4
+
+
+class _Peer:
+    """Running count and waiting jobs of one peer."""
+
+    __slots__ = ('running', 'queue')
+
+    def __init__(self):
+        self.running = 0
+        self.queue = deque()
+
+
+class TransferWorkers:
+    """Run transfer jobs on a shared thread pool with a concurrency cap per peer.
+
+    Jobs beyond a peer's cap wait in that peer's queue without holding a worker, so a slow peer
+    cannot starve the others. Jobs submitted with the same key, such as a destination path, run
+    one at a time in submission order. A job may return a Future instead of a result, to finish
+    later without keeping a worker busy.
+    """
+
+    def __init__(self, max_workers=TRANSFER_WORKERS, per_peer=PER_PEER_TRANSFERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tsync-transfer')
+        self.per_peer = per_peer
+        self.peers = {}  # peer -> _Peer
+        self.keys = {}  # key -> deque of jobs waiting behind the one in progress
+        self.lock = threading.Lock()
+
+    def submit(self, peer, key, fn, *args):
+        """Schedule fn(*args) for 'peer' and return a Future for its result."""
+        future = Future()
+        job = (peer, key, fn, args, future)
+        with self.lock:
+            if key in self.keys:
+                self.keys[key].append(job)
+            else:
+                self.keys[key] = deque()
+                self._enqueue(job)
+        return future
+
+    def _enqueue(self, job):
+        """Start a job if its peer has a free slot, otherwise queue it. Called with the lock held."""
+        state = self.peers.setdefault(job[0], _Peer())
+        if state.running < self.per_peer:
+            state.running += 1
+            self.executor.submit(self._run, job)
+        else:
+            state.queue.append(job)
+
+    def _run(self, job):
+        peer, key, fn, args, future = job
+        pending = None
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args)
+                except Exception as e:
+                    logger.error("Transfer job for %s failed: %s", peer, e)
+                    future.set_exception(e)
+                else:
+                    if isinstance(result, Future):
+                        pending = result
+                    else:
+                        future.set_result(result)
+        finally:
+            self._release_peer(peer)
+            if pending is None:
+                self._release_key(key)
+            else:
+                pending.add_done_callback(partial(self._finish, job))
+
+    def _finish(self, job, pending):
+        """Complete a job that handed back a Future, such as a transfer the peer runs in the background.
+
+        The worker was freed when the job returned; its key stays held until now so later jobs
+        on the same path still wait for it.
+        """
+        future = job[4]
+        try:
+            if pending.exception() is not None:
+                future.set_exception(pending.exception())
+            else:
+                future.set_result(pending.result())
+        finally:
+            self._release_key(job[1])
+
+    def _release_peer(self, peer):
+        with self.lock:
+            state = self.peers[peer]
+            state.running -= 1
+            if state.queue:
+                state.running += 1
+                self.executor.submit(self._run, state.queue.popleft())
+
+    def _release_key(self, key):
+        with self.lock:
+            waiting = self.keys[key]
+            if waiting:
+                self._enqueue(waiting.popleft())
+            else:
+                del self.keys[key]
+
+    def shutdown(self):
+        """Stop accepting work and wait for running jobs."""
+        self.executor.shutdown(wait=True)